@@ -0,0 +1,73 @@
+import numpy as np
+
+# Righe assegnate alle liste per blocco: limita la matrice (blocco x liste)
+ASSIGN_CHUNK_ROWS = 8192
+
+
+def _normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return (matrix / np.maximum(norms, 1e-8)).astype(np.float32)
+
+
+def _assign_lists(embeddings, centroids):
+    assign = np.empty(len(embeddings), dtype=np.int32)
+    for start in range(0, len(embeddings), ASSIGN_CHUNK_ROWS):
+        chunk = np.asarray(embeddings[start:start + ASSIGN_CHUNK_ROWS], dtype=np.float32)
+        assign[start:start + len(chunk)] = np.argmax(chunk @ centroids.T, axis=1)
+    return assign
+
+
+class IVFFlatIndex:
+    """
+    Indice IVF-flat sugli embedding L2-normalizzati dell'indice del tour.
+    Un k-means sferico divide le righe in n_lists liste; la ricerca confronta
+    le query con i centroidi e restituisce solo le righe delle n_probe liste
+    piu' vicine, che il chiamante ri-valuta in modo esatto.
+    """
+
+    def __init__(self, embeddings, n_lists=None, iterations=10, sample_size=20000, seed=0):
+        n_rows = len(embeddings)
+        if n_rows == 0:
+            raise ValueError("Cannot build an IVF index on an empty matrix")
+
+        if n_lists is None:
+            n_lists = int(round(np.sqrt(n_rows)))
+        n_lists = max(1, min(int(n_lists), n_rows))
+
+        rng = np.random.default_rng(seed)
+        if n_rows > sample_size:
+            sample_rows = np.sort(rng.choice(n_rows, sample_size, replace=False))
+            sample = embeddings[sample_rows]
+        else:
+            sample = embeddings
+        # Le righe int8 hanno una scala per riga: l'assegnazione alle liste
+        # (argmax del prodotto con i centroidi) non ne dipende.
+        sample = _normalize_rows(np.asarray(sample, dtype=np.float32))
+
+        centroids = sample[rng.choice(len(sample), n_lists, replace=False)].copy()
+        for _ in range(iterations):
+            assign = _assign_lists(sample, centroids)
+            order = np.argsort(assign, kind="stable")
+            used, starts = np.unique(assign[order], return_index=True)
+            # Le liste rimaste vuote tengono il centroide precedente
+            centroids[used] = _normalize_rows(np.add.reduceat(sample[order], starts, axis=0))
+
+        assign = _assign_lists(embeddings, centroids)
+        self.centroids = np.ascontiguousarray(centroids)
+        self.list_rows = np.argsort(assign, kind="stable").astype(np.int32)
+        self.list_offsets = np.r_[0, np.cumsum(np.bincount(assign, minlength=n_lists))]
+
+    @property
+    def n_lists(self):
+        return len(self.centroids)
+
+    def probe(self, queries, n_probe):
+        """Righe (crescenti) dell'unione delle n_probe liste piu' vicine a ogni query."""
+        n_probe = max(1, min(int(n_probe), self.n_lists))
+        scores = np.atleast_2d(queries) @ self.centroids.T
+        lists = np.unique(np.argpartition(-scores, n_probe - 1, axis=1)[:, :n_probe])
+        rows = np.concatenate([
+            self.list_rows[self.list_offsets[i]:self.list_offsets[i + 1]]
+            for i in lists
+        ])
+        return np.sort(rows)
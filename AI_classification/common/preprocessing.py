@@ -51,18 +51,23 @@ def preprocess_image_dart_compatible(pil_img: Image.Image) -> np.ndarray:
     pil_img = pil_img.crop((crop_x, crop_y, crop_x + INPUT_SIZE, crop_y + INPUT_SIZE))
     return np.array(pil_img, dtype=np.float32)
 
+def create_orb_clahe():
+    return cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
+
 def build_orb_input_from_bgr(
     bgr,
     use_clahe=True,
     use_edges=False,
     canny_low=80,
     canny_high=160,
-    edge_alpha=0.25
+    edge_alpha=0.25,
+    clahe=None
 ):
     gray = cv2.cvtColor(bgr, cv2.COLOR_BGR2GRAY)
     
     if use_clahe:
-        clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
+        if clahe is None:
+            clahe = create_orb_clahe()
         gray = clahe.apply(gray)
     
     if use_edges:
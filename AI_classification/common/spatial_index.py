@@ -0,0 +1,71 @@
+import math
+
+import numpy as np
+
+EARTH_RADIUS_M = 6371000.0
+METERS_PER_DEGREE_LAT = math.pi * EARTH_RADIUS_M / 180.0
+
+
+def haversine_distances_m(lat, lon, lats, lons):
+    """Distanze (m) tra un punto e gli array lats / lons, in gradi."""
+    phi1 = math.radians(lat)
+    phi2 = np.radians(lats)
+    delta_phi = phi2 - phi1
+    delta_lambda = np.radians(lons) - math.radians(lon)
+
+    a = np.sin(delta_phi / 2) ** 2 + math.cos(phi1) * np.cos(phi2) * np.sin(delta_lambda / 2) ** 2
+    return 2.0 * EARTH_RADIUS_M * np.arctan2(np.sqrt(a), np.sqrt(np.maximum(1.0 - a, 0.0)))
+
+
+class GeoGridIndex:
+    """
+    Bucket lat/lon (celle quadrate di circa cell_m metri in latitudine) sulle
+    posizioni dei waypoint. query() visita solo le celle che intersecano il
+    raggio richiesto e filtra i candidati con la distanza haversine esatta.
+    """
+
+    def __init__(self, ids, lats, lons, cell_m=500.0):
+        self.ids = np.asarray(ids, dtype=np.int32)
+        self.lats = np.asarray(lats, dtype=np.float64)
+        self.lons = np.asarray(lons, dtype=np.float64)
+        self.cell_deg = float(cell_m) / METERS_PER_DEGREE_LAT
+
+        buckets = {}
+        for position, (lat, lon) in enumerate(zip(self.lats, self.lons)):
+            buckets.setdefault(self._cell(lat, lon), []).append(position)
+        self.cells = {cell: np.asarray(positions, dtype=np.int32) for cell, positions in buckets.items()}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _cell(self, lat, lon):
+        return int(math.floor(lat / self.cell_deg)), int(math.floor(lon / self.cell_deg))
+
+    def _candidate_positions(self, lat, lon, radius_m):
+        lat_span = radius_m / METERS_PER_DEGREE_LAT
+        cos_lat = math.cos(math.radians(min(abs(lat) + lat_span, 89.9)))
+        lon_span = lat_span / max(cos_lat, 1e-6)
+
+        # Finestra oltre l'antimeridiano o piu' celle che bucket: scansione completa
+        if lon - lon_span < -180.0 or lon + lon_span > 180.0:
+            return np.arange(len(self.ids), dtype=np.int32)
+        lat_lo, lon_lo = self._cell(lat - lat_span, lon - lon_span)
+        lat_hi, lon_hi = self._cell(lat + lat_span, lon + lon_span)
+        if (lat_hi - lat_lo + 1) * (lon_hi - lon_lo + 1) > len(self.cells):
+            return np.arange(len(self.ids), dtype=np.int32)
+
+        blocks = [
+            self.cells[(i, j)]
+            for i in range(lat_lo, lat_hi + 1)
+            for j in range(lon_lo, lon_hi + 1)
+            if (i, j) in self.cells
+        ]
+        return np.concatenate(blocks) if blocks else np.zeros(0, dtype=np.int32)
+
+    def query(self, lat, lon, radius_m):
+        """Id (crescenti) dei punti entro radius_m metri da (lat, lon)."""
+        positions = self._candidate_positions(float(lat), float(lon), float(radius_m))
+        if len(positions) == 0:
+            return np.zeros(0, dtype=np.int32)
+        distances = haversine_distances_m(lat, lon, self.lats[positions], self.lons[positions])
+        return np.sort(self.ids[positions[distances <= radius_m]])
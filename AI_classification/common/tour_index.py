@@ -0,0 +1,304 @@
+import os
+import json
+import struct
+import hashlib
+from pathlib import Path
+import numpy as np
+
+from common.preprocessing import decode_descriptors_from_base64
+
+# --- Formato binario dell'indice del tour ---
+# [magic 8B][version uint32][header_len uint32][header JSON][padding][blocchi]
+# Ogni blocco e' un array NumPy grezzo allineato a BINARY_INDEX_ALIGNMENT byte,
+# con dtype/shape/offset descritti nell'header: il file si apre in memmap e
+# gli array restano condivisi tra i processi che leggono lo stesso file.
+BINARY_INDEX_MAGIC = b"XRTIDX\x00\x00"
+BINARY_INDEX_VERSION = 1
+BINARY_INDEX_SUFFIX = ".bin"
+BINARY_INDEX_ALIGNMENT = 64
+BINARY_INDEX_EMBEDDING_DTYPES = ("float32", "float16", "int8")
+
+# Il .bin porta nell'header il build_id del training_data.json da cui e'
+# generato; entrambi gli oggetti S3 lo hanno anche nei metadati, cosi' il
+# servizio di inferenza riconosce un .bin rimasto da un build precedente.
+INDEX_BUILD_ID_METADATA_KEY = "index-build-id"
+
+# Embedding nel JSON (letto anche dall'app mobile, che normalizza ogni
+# vettore): float16 arrotonda i valori, int8 salva interi in [-127, 127]
+# con la scala per vettore in "embedding_scale".
+JSON_INDEX_EMBEDDING_DTYPES = ("float32", "float16", "int8")
+INT8_EMBEDDING_MAX = 127
+
+ITEM_METADATA_KEYS = (
+    "waypoint_name",
+    "image_path",
+    "source_image_path",
+    "variant_name",
+    "variant_weight",
+    "use_for_geometry",
+    "has_gps",
+    "gps_lat",
+    "gps_lon",
+    "gps_radius_m",
+)
+
+
+def binary_index_path(json_path):
+    return Path(json_path).with_suffix(BINARY_INDEX_SUFFIX)
+
+
+def binary_index_key(index_key: str) -> str:
+    root, _ext = os.path.splitext(index_key)
+    return root + BINARY_INDEX_SUFFIX
+
+
+def index_build_id(json_path):
+    """sha256 (troncato) del contenuto di training_data.json."""
+    digest = hashlib.sha256()
+    with open(json_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()[:32]
+
+
+def _align(value):
+    return (value + BINARY_INDEX_ALIGNMENT - 1) // BINARY_INDEX_ALIGNMENT * BINARY_INDEX_ALIGNMENT
+
+
+def _keypoint_coords(entry):
+    # keypoints JSON: [[x, y], 0, 0, 0, 0, 0, 0]
+    coords = [p[0][:2] for p in entry.get("keypoints", [])]
+    return np.asarray(coords, dtype=np.float32).reshape(-1, 2)
+
+
+def quantize_embeddings(embeddings, dtype):
+    """
+    Restituisce (valori, scale). Per int8 la scala e' per riga, con
+    valori * scala ~= embedding; per float32/float16 scale e' None.
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    if dtype in ("float32", "float16"):
+        return embeddings.astype(dtype), None
+    if dtype != "int8":
+        raise ValueError(f"Unsupported embedding dtype: {dtype}")
+
+    max_abs = np.abs(embeddings).max(axis=1) if embeddings.size else np.zeros(len(embeddings))
+    scales = (np.maximum(max_abs, 1e-8) / INT8_EMBEDDING_MAX).astype(np.float32)
+    values = np.clip(
+        np.rint(embeddings / scales[:, None]), -INT8_EMBEDDING_MAX, INT8_EMBEDDING_MAX
+    ).astype(np.int8)
+    return values, scales
+
+
+def json_index_entries(index, embedding_dtype="float32"):
+    """Voci da serializzare in training_data.json con gli embedding nel formato scelto."""
+    if embedding_dtype not in JSON_INDEX_EMBEDDING_DTYPES:
+        raise ValueError(f"Unsupported embedding dtype: {embedding_dtype}")
+    if embedding_dtype == "float32":
+        return index
+
+    entries = []
+    for entry in index:
+        values, scales = quantize_embeddings([entry["embedding"]], embedding_dtype)
+        entry = dict(entry)
+        if scales is None:
+            # repr piu' corto che rilegge lo stesso float16
+            entry["embedding"] = [float(str(v)) for v in values[0]]
+        else:
+            entry["embedding"] = values[0].tolist()
+            entry["embedding_scale"] = float(scales[0])
+        entries.append(entry)
+    return entries
+
+
+def negative_similarity_percentiles(embeddings, waypoint_ids):
+    """
+    Percentili 90/95/99 delle similarita' coseno tra immagini originali di
+    waypoint diversi, da un'unica matrice di Gram. None se non ci sono
+    coppie negative (tour con un solo waypoint).
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    waypoint_ids = np.asarray(waypoint_ids)
+
+    gram = embeddings @ embeddings.T
+    negative_mask = np.triu(waypoint_ids[:, None] != waypoint_ids[None, :], k=1)
+    negatives = gram[negative_mask]
+    if negatives.size == 0:
+        return None
+
+    p90, p95, p99 = np.percentile(negatives, [90, 95, 99])
+    return {
+        "negative_p90": float(p90),
+        "negative_p95": float(p95),
+        "negative_p99": float(p99),
+    }
+
+
+def index_calibration_stats(index):
+    """Statistiche di calibrazione calcolate sugli originali delle voci dell'indice."""
+    originals = {}
+    for entry in index:
+        if entry.get("variant_name", "original") != "original":
+            continue
+        key = (entry["waypoint_name"], entry.get("source_image_path", entry["image_path"]))
+        originals.setdefault(key, entry["embedding"])
+
+    if not originals:
+        return None
+
+    embeddings = np.asarray(list(originals.values()), dtype=np.float32)
+    embeddings /= np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-8)
+    waypoint_names = [waypoint_name for waypoint_name, _src in originals]
+    _, waypoint_ids = np.unique(waypoint_names, return_inverse=True)
+
+    return negative_similarity_percentiles(embeddings, waypoint_ids)
+
+
+def write_binary_index(index, output_path, embedding_dtype="float32", calibration=None, build_id=None):
+    if embedding_dtype not in BINARY_INDEX_EMBEDDING_DTYPES:
+        raise ValueError(f"Unsupported embedding dtype: {embedding_dtype}")
+
+    count = len(index)
+    embeddings = np.asarray([e["embedding"] for e in index], dtype=np.float32).reshape(count, -1)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    embeddings, embedding_scales = quantize_embeddings(embeddings / np.maximum(norms, 1e-8), embedding_dtype)
+
+    descriptor_blocks = []
+    keypoint_blocks = []
+    descriptor_offsets = np.zeros(count + 1, dtype=np.int64)
+    keypoint_offsets = np.zeros(count + 1, dtype=np.int64)
+    descriptor_cols = 32
+
+    for i, entry in enumerate(index):
+        descriptors = decode_descriptors_from_base64(
+            entry.get("descriptors_b64", ""),
+            int(entry.get("desc_rows", 0)),
+            int(entry.get("desc_cols", 0)),
+        )
+        rows = 0
+        if descriptors is not None:
+            descriptor_cols = descriptors.shape[1]
+            descriptor_blocks.append(descriptors)
+            rows = len(descriptors)
+        descriptor_offsets[i + 1] = descriptor_offsets[i] + rows
+
+        coords = _keypoint_coords(entry)
+        keypoint_blocks.append(coords)
+        keypoint_offsets[i + 1] = keypoint_offsets[i] + len(coords)
+
+    arrays = {
+        "embeddings": embeddings,
+        "descriptors": (
+            np.concatenate(descriptor_blocks, axis=0) if descriptor_blocks
+            else np.zeros((0, descriptor_cols), dtype=np.uint8)
+        ),
+        "descriptor_offsets": descriptor_offsets,
+        "keypoints": (
+            np.concatenate(keypoint_blocks, axis=0) if keypoint_blocks
+            else np.zeros((0, 2), dtype=np.float32)
+        ),
+        "keypoint_offsets": keypoint_offsets,
+    }
+    if embedding_scales is not None:
+        arrays["embedding_scales"] = embedding_scales
+
+    array_specs = {}
+    offset = 0
+    for name, array in arrays.items():
+        array_specs[name] = {
+            "dtype": array.dtype.str,
+            "shape": list(array.shape),
+            "offset": offset,
+        }
+        offset = _align(offset + array.nbytes)
+
+    header = {
+        "version": BINARY_INDEX_VERSION,
+        "count": count,
+        "embedding_dtype": embedding_dtype,
+        "normalized": True,
+        "calibration": calibration,
+        "build_id": build_id,
+        "items": [
+            {key: entry.get(key) for key in ITEM_METADATA_KEYS}
+            for entry in index
+        ],
+        "arrays": array_specs,
+    }
+    header_bytes = json.dumps(header, ensure_ascii=False).encode("utf-8")
+    data_start = _align(len(BINARY_INDEX_MAGIC) + 8 + len(header_bytes))
+
+    output_path = Path(output_path)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(output_path, "wb") as f:
+        f.write(BINARY_INDEX_MAGIC)
+        f.write(struct.pack("<II", BINARY_INDEX_VERSION, len(header_bytes)))
+        f.write(header_bytes)
+        for name, array in arrays.items():
+            f.seek(data_start + array_specs[name]["offset"])
+            f.write(np.ascontiguousarray(array).tobytes())
+
+    return output_path
+
+
+def read_binary_index_header(path):
+    with open(path, "rb") as f:
+        magic = f.read(len(BINARY_INDEX_MAGIC))
+        if magic != BINARY_INDEX_MAGIC:
+            raise ValueError(f"Not a binary tour index: {path}")
+
+        version, header_len = struct.unpack("<II", f.read(8))
+        if version != BINARY_INDEX_VERSION:
+            raise ValueError(f"Unsupported binary index version {version} in {path}")
+
+        header = json.loads(f.read(header_len).decode("utf-8"))
+
+    header["data_start"] = _align(len(BINARY_INDEX_MAGIC) + 8 + header_len)
+    return header
+
+
+def load_binary_index(path, mmap=True):
+    """
+    Restituisce (items, arrays, metadata). Gli item hanno gli stessi
+    metadati dell'indice JSON, senza embedding; per le immagini con feature
+    ORB contengono "descriptors" e "keypoint_coords" come viste sugli array.
+    metadata contiene le voci dell'header (versione, calibrazione, ...).
+    """
+    header = read_binary_index_header(path)
+    data_start = header["data_start"]
+
+    arrays = {}
+    for name, spec in header["arrays"].items():
+        dtype = np.dtype(spec["dtype"])
+        shape = tuple(spec["shape"])
+        if int(np.prod(shape)) == 0:
+            arrays[name] = np.zeros(shape, dtype=dtype)
+        elif mmap:
+            arrays[name] = np.memmap(
+                path, dtype=dtype, mode="r", offset=data_start + spec["offset"], shape=shape
+            )
+        else:
+            arrays[name] = np.fromfile(
+                path, dtype=dtype, count=int(np.prod(shape)), offset=data_start + spec["offset"]
+            ).reshape(shape)
+
+    descriptors = arrays["descriptors"]
+    descriptor_offsets = np.asarray(arrays["descriptor_offsets"])
+    keypoints = arrays["keypoints"]
+    keypoint_offsets = np.asarray(arrays["keypoint_offsets"])
+
+    items = header["items"]
+    for i, item in enumerate(items):
+        d0, d1 = int(descriptor_offsets[i]), int(descriptor_offsets[i + 1])
+        k0, k1 = int(keypoint_offsets[i]), int(keypoint_offsets[i + 1])
+        item["desc_rows"] = d1 - d0
+        item["desc_cols"] = int(descriptors.shape[1]) if d1 > d0 else 0
+        if d1 > d0:
+            item["descriptors"] = np.asarray(descriptors[d0:d1])
+            item["keypoint_coords"] = np.asarray(keypoints[k0:k1])
+
+    metadata = {
+        key: value for key, value in header.items()
+        if key not in ("items", "arrays")
+    }
+    return items, arrays, metadata
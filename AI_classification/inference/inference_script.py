@@ -8,23 +8,35 @@ if str(PROJECT_ROOT) not in sys.path:
     sys.path.insert(0, str(PROJECT_ROOT))
 
 import os
+import io
 import cv2
 import json
+import time
+import queue
+import threading
 import argparse
 import numpy as np
-from collections import defaultdict
 from PIL import Image
 from tensorflow import lite as tflite
 import math
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 
 from common.preprocessing import (
     preprocess_image_dart_compatible,
     build_query_views_pil,
     build_orb_input_from_bgr,
+    create_orb_clahe,
     decode_descriptors_from_base64,
-    cosine_similarity_np,
     get_query_view_weights
 )
+from common.ann_index import IVFFlatIndex
+from common.spatial_index import GeoGridIndex
+from common.tour_index import (
+    BINARY_INDEX_SUFFIX,
+    load_binary_index,
+    negative_similarity_percentiles,
+)
 
 # --- Configurazione e Iperparametri ---
 # Soglia minima per considerare un waypoint
@@ -52,10 +64,94 @@ GEOMETRY_STRONG_RATIO = 0.12
 GEOMETRY_RESCUE_MIN_SCORE = 0.56
 GEOMETRY_RESCUE_MIN_MARGIN = 0.015
 
+# Backend dei match ORB: "bf" (esatto), "flann_lsh", "bf_waypoint"
+GEOMETRY_MATCHER_BACKENDS = ("bf", "flann_lsh", "bf_waypoint")
+GEOMETRY_MATCHER_BACKEND = "bf"
+FLANN_LSH_INDEX_PARAMS = dict(algorithm=6, table_number=6, key_size=12, multi_probe_level=1)
+FLANN_LSH_SEARCH_PARAMS = dict(checks=50)
+WAYPOINT_MATCHER_KNN = 4
+
+# Pool condiviso per la verifica geometrica parallela dei candidati
+GEOMETRY_MAX_WORKERS = int(os.getenv("GEOMETRY_MAX_WORKERS", "4"))
+_GEOMETRY_EXECUTOR = None
+_GEOMETRY_EXECUTOR_LOCK = threading.Lock()
+
+# Ricerca approssimata (IVF-flat) per indici grandi, es. tour misti con
+# sub_tours: sotto ANN_MIN_ITEMS embedding la scansione esaustiva resta
+# esatta e abbastanza veloce. Le prime ANN_TOP_SOURCES sorgenti trovate
+# vengono poi ri-valutate in modo esatto con tutte le loro varianti.
+ANN_MIN_ITEMS = 20000
+ANN_N_PROBE = 8
+ANN_TOP_SOURCES = 200
+
+# Ranking gerarchico per tour con molti waypoint: la query si confronta
+# prima con i centroidi, poi il punteggio per item si calcola solo sui primi
+# HIERARCHICAL_TOP_WAYPOINTS waypoint e su quelli entro
+# HIERARCHICAL_CENTROID_MARGIN dall'ultimo tenuto. Sotto
+# HIERARCHICAL_MIN_WAYPOINTS waypoint resta la scansione esaustiva.
+HIERARCHICAL_MIN_WAYPOINTS = 100
+HIERARCHICAL_TOP_WAYPOINTS = 20
+HIERARCHICAL_CENTROID_MARGIN = 0.10
+
+# Righe per blocco nel prodotto con matrici float16 / int8 (embedding_scores)
+EMBEDDING_SCORE_BLOCK_ROWS = 4096
+
+# Dimensioni fisse dei batch TFLite: ogni batch viene completato (padding)
+# fino al bucket successivo e quelli piu' grandi dell'ultimo bucket vengono
+# divisi, cosi' resize_tensor_input + allocate_tensors avvengono una volta
+# per bucket invece che a ogni batch di dimensione diversa.
+EMBED_BATCH_BUCKETS = (1, 4, 8, 16)
+
 TOP_WAYPOINTS_TO_VERIFY = 5
 TOP_ITEMS_FOR_WAYPOINT_SCORE = 3
 MULTI_VIEW_ENABLED = False #TODO: valutare effettiva efficacia
 
+# Cascata di confidenza sulle viste della query (con MULTI_VIEW_ENABLED):
+# si embedda e classifica uno stadio alla volta e ci si ferma appena il
+# direct accept e' certo; altrimenti si prosegue fino alla geometria.
+# Un'uscita anticipata decide sulle sole viste embeddate fin li' (con la
+# sola center il vote ratio e' 1.0 e i consensus sono diversi da quelli a
+# 10 viste): puo' accettare query che il ranking completo rifiuterebbe.
+# Misurare l'errore per stadio (benchmark, decided_by) prima di attivarla.
+QUERY_VIEW_CASCADE = (
+    ("center", ("center",)),
+    ("crops", ("crop_center", "crop_left", "crop_right", "crop_top", "crop_bottom")),
+    ("photometric", ("brightness_down_q", "brightness_up_q", "contrast_down_q", "contrast_up_q")),
+)
+
+# Risoluzioni di lavoro della query (px). Una sola decodifica ridotta con
+# lato lungo QUERY_DECODE_MAX_SIDE; da quella derivano:
+#  - embedding: lato corto QUERY_EMBEDDING_MIN_SIDE (2.5 volte i 256 px del
+#    preprocessing: viste e crop costano poco e il ridimensionamento finale
+#    resta quasi identico a quello dall'immagine piena);
+#  - ORB: lato lungo QUERY_ORB_MAX_SIDE (i keypoint restano nelle coordinate
+#    della query, la soglia RANSAC e' in quelle del riferimento);
+#  - luminosita', contrasto e pHash: lato lungo QUERY_QUALITY_MAX_SIDE.
+# La varianza del Laplaciano (blur) dipende fortemente dalla risoluzione:
+# le soglie 35 / 70 di assess_image_quality valgono per le foto inviate
+# dall'app (lato corto 1024 px, camera_screen.dart), quindi il blur si
+# misura prima della riduzione, con lato corto QUERY_BLUR_MIN_SIDE.
+QUERY_DECODE_MAX_SIDE = int(os.getenv("QUERY_DECODE_MAX_SIDE", "1280"))
+QUERY_EMBEDDING_MIN_SIDE = 640
+QUERY_ORB_MAX_SIDE = 1280
+QUERY_QUALITY_MAX_SIDE = 640
+QUERY_BLUR_MIN_SIDE = 1024
+
+# Orientamento EXIF -> trasposizione PIL (stessa tabella di
+# ImageOps.exif_transpose). Come nel training, l'embedding usa i pixel cosi'
+# come sono (Image.open) mentre ORB e qualita' usano l'immagine orientata
+# (cv2.imread applica l'orientamento EXIF).
+EXIF_ORIENTATION_TAG = 0x0112
+EXIF_ORIENTATION_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
 GPS_PRIOR_WEIGHT = 0.20 #Quanto puo' aggiungere o rimuovere il GPS dal punteggio finale
 GPS_DEFAULT_RADIUS_M = 75.0 #Raggio di confidenza predefinito per i punti GPS degli item (considerando anche possibili errori o spostamenti)
 GPS_DEFAULT_ACCURACY_M = 30.0
@@ -63,111 +159,710 @@ GPS_MIN_CONFIDENCE = 0.25
 GPS_FAR_MULTIPLIER = 4.0 #Distanza a cui considerare un punto GPS come "lontano" (e quindi con affinity 0) in base al raggio di confidenza. Es: 4x il raggio -> entro 4x il raggio -> affinity > 0 | oltre 4x il raggio -> affinity = 0
 GPS_MIN_FAR_DISTANCE_M = 250.0 #Distanza minima a cui considerare un punto GPS come "lontano" indipendentemente dal raggio di confidenza (utile per evitare che punti con raggio molto piccolo abbiano affinity > 0 anche a distanze elevate)
 
+# Prefiltro spaziale: con GPS preciso si valutano solo i waypoint entro un
+# raggio prudente (GPS_PREFILTER_FAR_FACTOR volte la distanza "lontana" del
+# prior GPS, almeno GPS_PREFILTER_MIN_RADIUS_M). Costruito solo per tour con
+# almeno GPS_PREFILTER_MIN_WAYPOINTS waypoint geolocalizzati.
+GPS_PREFILTER_MIN_WAYPOINTS = int(os.getenv("GPS_PREFILTER_MIN_WAYPOINTS", "20"))
+GPS_PREFILTER_MAX_ACCURACY_M = 100.0
+GPS_PREFILTER_FAR_FACTOR = 2.0
+GPS_PREFILTER_MIN_RADIUS_M = 1000.0
+GPS_PREFILTER_MIN_CANDIDATES = 2
+GPS_PREFILTER_CELL_M = 500.0
+
+
+ORB_QUERY_FEATURES = 5000
+ORB_QUERY_FAST_THRESHOLD = 10
+
+# ORB, CLAHE e matcher non sono thread-safe ma sono riusabili: un'istanza
+# per thread evita di ricostruirli a ogni verifica geometrica.
+_THREAD_LOCAL = threading.local()
+
+
+def thread_local_instance(name, factory):
+    instance = getattr(_THREAD_LOCAL, name, None)
+    if instance is None:
+        instance = factory()
+        setattr(_THREAD_LOCAL, name, instance)
+    return instance
+
+
+def thread_orb():
+    return thread_local_instance(
+        "orb",
+        lambda: cv2.ORB_create(nfeatures=ORB_QUERY_FEATURES, fastThreshold=ORB_QUERY_FAST_THRESHOLD),
+    )
+
+
+def thread_clahe():
+    return thread_local_instance("clahe", create_orb_clahe)
+
+
+def thread_bf_matcher():
+    return thread_local_instance("bf_matcher", lambda: cv2.BFMatcher(cv2.NORM_HAMMING))
+
 
-def load_tflite_interpreter(tflite_path: Path):
-    interpreter = tflite.Interpreter(model_path=str(tflite_path))
+@contextmanager
+def stage_timer(timings, stage):
+    """Somma in timings[stage] i secondi spesi nel blocco (nulla se timings e' None)."""
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - start
+
+
+def load_tflite_interpreter(tflite_path: Path, num_threads=None):
+    interpreter = tflite.Interpreter(model_path=str(tflite_path), num_threads=num_threads)
     interpreter.allocate_tensors()
     return interpreter
 
 
-def run_tflite_embedder(interpreter, image_array: np.ndarray) -> np.ndarray:
-    input_details = interpreter.get_input_details()[0]
-    output_details = interpreter.get_output_details()[0]
+class TFLiteEmbedder:
+    """
+    Embedder su un interprete TFLite con i dettagli dei tensori in cache.
+    I batch vengono completati fino a uno dei batch_buckets, cosi' tutte le
+    viste di una query passano in un solo invoke senza riallocare a ogni
+    dimensione; con interpreter_factory ogni bucket ha il proprio interprete,
+    allocato una volta sola. Se il modello non accetta il resize ricade su
+    un invoke per immagine con batch 1.
+    """
+
+    def __init__(self, interpreter, interpreter_factory=None, batch_buckets=EMBED_BATCH_BUCKETS):
+        self.interpreter = interpreter
+        self.interpreter_factory = interpreter_factory
+        self.batch_buckets = tuple(sorted({max(1, int(b)) for b in batch_buckets}))
+        self.supports_batch = True
+        self._refresh_details()
+        self._interpreters = {self.batch_size: interpreter}
+
+    def _refresh_details(self):
+        self.input_details = self.interpreter.get_input_details()[0]
+        self.output_details = self.interpreter.get_output_details()[0]
+        self.batch_size = int(self.input_details["shape"][0])
+
+    def _resize_batch(self, batch_size):
+        batch_size = int(batch_size)
+        if batch_size == self.batch_size:
+            return
+
+        interpreter = self._interpreters.get(batch_size)
+        if interpreter is None:
+            if self.interpreter_factory is not None:
+                interpreter = self.interpreter_factory()
+            else:
+                # Un solo interprete: si rialloca a ogni cambio di bucket
+                interpreter = self.interpreter
+                self._interpreters.pop(self.batch_size, None)
+            input_details = interpreter.get_input_details()[0]
+            shape = [batch_size] + [int(d) for d in input_details["shape"][1:]]
+            interpreter.resize_tensor_input(input_details["index"], shape)
+            interpreter.allocate_tensors()
+            self._interpreters[batch_size] = interpreter
+
+        self.interpreter = interpreter
+        self._refresh_details()
+
+    def _bucket(self, n_images):
+        return next((b for b in self.batch_buckets if b >= n_images), self.batch_buckets[-1])
+
+    def _embed_bucketed(self, batch):
+        chunks = []
+        for start in range(0, len(batch), self.batch_buckets[-1]):
+            chunk = batch[start:start + self.batch_buckets[-1]]
+            bucket = self._bucket(len(chunk))
+            if bucket > len(chunk):
+                padding = np.zeros((bucket - len(chunk),) + chunk.shape[1:], dtype=chunk.dtype)
+                chunk_input = np.concatenate([chunk, padding])
+            else:
+                chunk_input = chunk
+            self._resize_batch(bucket)
+            chunks.append(self._invoke(chunk_input)[:len(chunk)])
+        return np.concatenate(chunks)
+
+    def _invoke(self, tensor):
+        self.interpreter.set_tensor(self.input_details["index"], tensor)
+        self.interpreter.invoke()
+        output = self.interpreter.get_tensor(self.output_details["index"])
+        return output.reshape(tensor.shape[0], -1)
+
+    def _embed_one_by_one(self, batch):
+        self._resize_batch(1)
+        return np.concatenate([self._invoke(batch[i:i + 1]) for i in range(len(batch))])
+
+    def embed_batch(self, image_arrays, timings=None):
+        batch = np.stack(image_arrays).astype(self.input_details["dtype"])
+
+        embeddings = None
+        if self.supports_batch or len(batch) == 1:
+            try:
+                embeddings = self._embed_bucketed(batch)
+            except Exception as e:
+                print(f"Batch TFLite non supportato, uso batch 1: {e}")
+                self.supports_batch = False
+
+        if embeddings is None:
+            embeddings = self._embed_one_by_one(batch)
+
+        embeddings = embeddings.astype(np.float32)
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return np.where(norms > 1e-6, embeddings / np.maximum(norms, 1e-6), embeddings)
+
+    def embed(self, image_array):
+        return self.embed_batch([image_array])[0]
+
+
+class TFLiteEmbedderPool:
+    """
+    Pool di interpreti TFLite, ciascuno con il proprio TFLiteEmbedder e
+    num_threads. Ogni chiamata prende in prestito un interprete solo per la
+    durata dell'embedding: ranking e geometria girano in parallelo.
+    """
+
+    def __init__(self, tflite_path, size=1, num_threads=None, batch_buckets=EMBED_BATCH_BUCKETS):
+        self.size = max(1, int(size))
+        self._embedders = queue.Queue()
+
+        def interpreter_factory():
+            return load_tflite_interpreter(tflite_path, num_threads=num_threads)
+
+        for _ in range(self.size):
+            self._embedders.put(TFLiteEmbedder(
+                interpreter_factory(),
+                interpreter_factory=interpreter_factory,
+                batch_buckets=batch_buckets,
+            ))
+
+    @contextmanager
+    def acquire(self):
+        embedder = self._embedders.get()
+        try:
+            yield embedder
+        finally:
+            self._embedders.put(embedder)
+
+    def embed_batch(self, image_arrays, timings=None):
+        queued_at = time.perf_counter()
+        with self.acquire() as embedder:
+            # Attesa di un interprete libero
+            if timings is not None:
+                timings["embedding_queue_wait"] = (
+                    timings.get("embedding_queue_wait", 0.0) + time.perf_counter() - queued_at
+                )
+            return embedder.embed_batch(image_arrays)
+
+    def embed(self, image_array):
+        return self.embed_batch([image_array])[0]
+
+
+class MicroBatchingEmbedder:
+    """
+    Scheduler di micro-batch davanti a un TFLiteEmbedderPool: le richieste
+    di embedding concorrenti vengono raccolte per al massimo max_wait_ms o
+    max_batch immagini ed eseguite in un solo invoke batched. Una richiesta
+    che farebbe superare max_batch resta in attesa per il batch successivo
+    (una richiesta da sola piu' grande viene divisa in piu' invoke). C'e' un thread
+    dispatcher per interprete del pool; i chiamanti (thread del threadpool
+    del servizio) attendono solo il proprio Future e poi proseguono con
+    ranking e geometria sul proprio contesto del tour.
+    """
+
+    def __init__(self, pool, max_batch=16, max_wait_ms=5.0):
+        self.pool = pool
+        self.max_batch = max(1, int(max_batch))
+        self.max_wait_s = max(0.0, float(max_wait_ms)) / 1000.0
+        self._requests = queue.Queue()
+        self._stats_lock = threading.Lock()
+        self.batches = 0
+        self.images = 0
+
+        for i in range(pool.size):
+            threading.Thread(
+                target=self._dispatch_loop,
+                name=f"embed-batcher-{i}",
+                daemon=True,
+            ).start()
+
+    def _collect(self, first):
+        """(batch, immagini, richiesta tenuta da parte per il batch successivo)."""
+        batch = [first]
+        n_images = len(first[0])
+        deadline = time.monotonic() + self.max_wait_s
+
+        while n_images < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = self._requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if n_images + len(request[0]) > self.max_batch:
+                return batch, n_images, request
+            batch.append(request)
+            n_images += len(request[0])
+
+        return batch, n_images, None
+
+    def _dispatch_loop(self):
+        held = None
+        while True:
+            first = held if held is not None else self._requests.get()
+            batch, n_images, held = self._collect(first)
+            image_arrays = [array for arrays, _future, _queued_at in batch for array in arrays]
+            started_at = time.perf_counter()
+
+            try:
+                # Una richiesta da sola oltre max_batch viene divisa
+                embeddings = np.concatenate([
+                    self.pool.embed_batch(image_arrays[start:start + self.max_batch])
+                    for start in range(0, len(image_arrays), self.max_batch)
+                ])
+            except Exception as e:
+                for _arrays, future, _queued_at in batch:
+                    future.set_exception(e)
+                continue
 
-    tensor = np.expand_dims(image_array, axis=0).astype(input_details["dtype"])
-    interpreter.set_tensor(input_details["index"], tensor)
-    interpreter.invoke()
-    embedding = interpreter.get_tensor(output_details["index"]).squeeze()
+            with self._stats_lock:
+                self.batches += 1
+                self.images += n_images
+
+            offset = 0
+            for arrays, future, queued_at in batch:
+                # Insieme agli embedding, l'attesa in coda fino all'avvio del batch
+                future.set_result((embeddings[offset:offset + len(arrays)], started_at - queued_at))
+                offset += len(arrays)
+
+    def embed_batch(self, image_arrays, timings=None):
+        future = Future()
+        self._requests.put((list(image_arrays), future, time.perf_counter()))
+        embeddings, queue_wait_s = future.result()
+        if timings is not None:
+            timings["embedding_queue_wait"] = timings.get("embedding_queue_wait", 0.0) + queue_wait_s
+        return embeddings
+
+    def embed(self, image_array):
+        return self.embed_batch([image_array])[0]
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                "batches": self.batches,
+                "images": self.images,
+                "mean_batch_size": self.images / self.batches if self.batches else 0.0,
+            }
 
-    norm = np.linalg.norm(embedding)
-    if norm > 1e-6:
-        embedding = embedding / norm
 
-    return embedding.astype(np.float32)
+def scaled_size(size, max_side=None, min_side=None):
+    """
+    Dimensioni (w, h) a rapporto costante con lato lungo max_side oppure
+    lato corto min_side; mai ingrandite.
+    """
+    w, h = size
+    if max_side:
+        scale = max_side / max(w, h)
+    elif min_side:
+        scale = min_side / min(w, h)
+    else:
+        scale = 1.0
+    if scale >= 1.0:
+        return w, h
+    return max(1, round(w * scale)), max(1, round(h * scale))
+
+
+def laplacian_variance(pil_image, min_side=QUERY_BLUR_MIN_SIDE):
+    """Varianza del Laplaciano in grigio, con lato corto ridotto a min_side."""
+    gray = np.asarray(pil_image.convert("L"))
+    size = scaled_size(pil_image.size, min_side=min_side)
+    if size != pil_image.size:
+        gray = cv2.resize(gray, size, interpolation=cv2.INTER_AREA)
+    return float(cv2.Laplacian(gray, cv2.CV_64F).var())
+
+
+class QueryImage:
+    """
+    Immagine di query decodificata una sola volta, a risoluzione ridotta:
+    i JPEG vengono decodificati con il draft di PIL (scala DCT 1/2, 1/4,
+    1/8) e poi portati a QUERY_DECODE_MAX_SIDE. Le rappresentazioni
+    derivate sono calcolate al primo uso e riusate nella richiesta:
+      - embedding_pil: lato corto QUERY_EMBEDDING_MIN_SIDE, per le viste
+        e il preprocessing del modello;
+      - bgr: lato lungo QUERY_ORB_MAX_SIDE, per ORB;
+      - gray: lato lungo QUERY_QUALITY_MAX_SIDE, per le metriche di
+        qualita' e il pHash.
+    blur_var (varianza del Laplaciano) si calcola subito, sull'immagine
+    decodificata a lato corto QUERY_BLUR_MIN_SIDE, prima della riduzione.
+    bgr e gray sono ruotati secondo l'orientamento EXIF (`orientation`),
+    come con cv2.imread; embedding_pil no, come Image.open nel training.
+    """
+
+    def __init__(self, pil_image, max_side=QUERY_DECODE_MAX_SIDE, orientation=1):
+        pil_image = pil_image.convert("RGB")
+        self.blur_var = laplacian_variance(pil_image)
+        size = scaled_size(pil_image.size, max_side=max_side)
+        if size != pil_image.size:
+            pil_image = pil_image.resize(size, Image.BILINEAR, reducing_gap=2.0)
+        self.pil = pil_image
+        self.orientation = orientation
+        self._embedding_pil = None
+        self._views = None
+        self._bgr = None
+        self._gray = None
+        self._orb_features = None
+        self._orb_lock = threading.Lock()
+
+    @classmethod
+    def from_file(cls, fileobj, max_side=QUERY_DECODE_MAX_SIDE):
+        try:
+            pil_image = Image.open(fileobj)
+            if max_side:
+                # Solo JPEG: decodifica gia' ridotta, con entrambi i lati
+                # non inferiori alla dimensione di lavoro
+                pil_image.draft("RGB", scaled_size(pil_image.size, max_side=max_side))
+            pil_image.load()
+            orientation = pil_image.getexif().get(EXIF_ORIENTATION_TAG, 1)
+        except Exception as e:
+            raise ValueError(f"Immagine non decodificabile: {e}")
+        return cls(pil_image, max_side=max_side, orientation=orientation)
+
+    @classmethod
+    def from_bytes(cls, image_bytes, max_side=QUERY_DECODE_MAX_SIDE):
+        return cls.from_file(io.BytesIO(image_bytes), max_side=max_side)
+
+    @classmethod
+    def from_path(cls, image_path, max_side=QUERY_DECODE_MAX_SIDE):
+        with open(image_path, "rb") as f:
+            return cls.from_file(f, max_side=max_side)
+
+    @property
+    def embedding_pil(self):
+        if self._embedding_pil is None:
+            size = scaled_size(self.pil.size, min_side=QUERY_EMBEDDING_MIN_SIDE)
+            self._embedding_pil = (
+                self.pil.resize(size, Image.BICUBIC, reducing_gap=2.0)
+                if size != self.pil.size
+                else self.pil
+            )
+        return self._embedding_pil
+
+    def views(self):
+        """Viste della query (build_query_views_pil) costruite una volta sola."""
+        if self._views is None:
+            self._views = build_query_views_pil(self.embedding_pil)
+        return self._views
+
+    @property
+    def bgr(self):
+        if self._bgr is None:
+            pil_image = self.pil
+            transpose = EXIF_ORIENTATION_TRANSPOSE.get(self.orientation)
+            if transpose is not None:
+                pil_image = pil_image.transpose(transpose)
+            bgr = cv2.cvtColor(np.asarray(pil_image), cv2.COLOR_RGB2BGR)
+            w, h = scaled_size(pil_image.size, max_side=QUERY_ORB_MAX_SIDE)
+            if (w, h) != pil_image.size:
+                bgr = cv2.resize(bgr, (w, h), interpolation=cv2.INTER_AREA)
+            self._bgr = bgr
+        return self._bgr
+
+    @property
+    def gray(self):
+        if self._gray is None:
+            gray = cv2.cvtColor(self.bgr, cv2.COLOR_BGR2GRAY)
+            w, h = scaled_size((gray.shape[1], gray.shape[0]), max_side=QUERY_QUALITY_MAX_SIDE)
+            if (w, h) != (gray.shape[1], gray.shape[0]):
+                gray = cv2.resize(gray, (w, h), interpolation=cv2.INTER_AREA)
+            self._gray = gray
+        return self._gray
+
+    def orb_features(self):
+        """
+        Keypoint (N, 2) float32 e descrittori ORB della query, estratti una
+        sola volta e condivisi da tutte le verifiche geometriche.
+        """
+        with self._orb_lock:
+            if self._orb_features is None:
+                orb_input = build_orb_input_from_bgr(
+                    self.bgr,
+                    use_clahe=True,
+                    use_edges=False,
+                    clahe=thread_clahe(),
+                )
+                keypoints, descriptors = thread_orb().detectAndCompute(orb_input, None)
+                coords = np.float32([k.pt for k in keypoints or []]).reshape(-1, 2)
+                self._orb_features = (coords, descriptors)
+        return self._orb_features
+
+    def perceptual_hash(self):
+        """
+        pHash a 64 bit: DCT della query in grigio ridotta a 32x32, segno dei
+        coefficienti 8x8 a bassa frequenza rispetto alla mediana (DC escluso).
+        Frame quasi identici differiscono di pochi bit.
+        """
+        small = cv2.resize(self.gray, (32, 32), interpolation=cv2.INTER_AREA)
+        low = cv2.dct(np.float32(small))[:8, :8].flatten()
+        bits = low > np.median(low[1:])
+        return int(np.packbits(bits).view(">u8")[0])
+
+
+class QueryImageStream:
+    """
+    Raccoglie i chunk del body HTTP in un unico buffer compresso e decodifica
+    con QueryImage.from_file, cosi' i JPEG passano dal draft a scala ridotta
+    (l'ImageFile.Parser incrementale di PIL decodifica sempre a piena
+    risoluzione).
+    """
+
+    def __init__(self, max_side=QUERY_DECODE_MAX_SIDE):
+        self.buffer = io.BytesIO()
+        self.max_side = max_side
+        self.nbytes = 0
+
+    def feed(self, chunk):
+        self.nbytes += len(chunk)
+        self.buffer.write(chunk)
+
+    def close(self):
+        """QueryImage decodificata; ValueError se il body e' vuoto o non valido."""
+        self.buffer.seek(0)
+        try:
+            return QueryImage.from_file(self.buffer, max_side=self.max_side)
+        finally:
+            self.buffer = io.BytesIO()
 
 
-def extract_query_embeddings_multi_view_tflite(image_path, interpreter):
-    image = Image.open(image_path).convert("RGB")
+def extract_query_embeddings_multi_view_tflite(image, embedder, timings=None):
     views = build_query_views_pil(image)
 
-    embeddings = {}
-    for view_name, pil_img in views.items():
-        processed = preprocess_image_dart_compatible(pil_img)
-        emb = run_tflite_embedder(interpreter, processed)
-        embeddings[view_name] = emb
+    processed = [preprocess_image_dart_compatible(pil_img) for pil_img in views.values()]
+    embeddings = embedder.embed_batch(processed, timings=timings)
+
+    return dict(zip(views.keys(), embeddings))
+
+def build_embedding_index(waypoint_index, embeddings=None, embedding_scales=None):
+    """
+    Impacchetta gli embedding dell'indice in una matrice contigua (N, D)
+    L2-normalizzata, ordinata per sorgente, con gli array interi di
+    waypoint / immagine sorgente / variante allineati alle colonne.
+    Con `embeddings` (indice binario, gia' normalizzato e ordinato) la
+    matrice viene usata senza copie nel suo dtype (float32, float16 o int8
+    con `embedding_scales` per riga): vedi embedding_scores.
+    """
+    from_items = embeddings is None
+    if from_items:
+        embeddings = []
+    waypoint_ids = {}
+    source_ids = {}
+    variant_ids = {}
+
+    item_waypoint_ids = []
+    item_source_ids = []
+    item_variant_ids = []
+    item_variant_weights = []
+
+    for item in waypoint_index:
+        waypoint_name = item["waypoint_name"]
+        source_image_path = item.get("source_image_path", item["image_path"])
+        variant_name = item.get("variant_name", "original")
 
-    return embeddings
+        waypoint_id = waypoint_ids.setdefault(waypoint_name, len(waypoint_ids))
+        source_id = source_ids.setdefault((waypoint_name, source_image_path), len(source_ids))
+        variant_id = variant_ids.setdefault(variant_name, len(variant_ids))
+
+        item_waypoint_ids.append(waypoint_id)
+        item_source_ids.append(source_id)
+        item_variant_ids.append(variant_id)
+        item_variant_weights.append(float(item.get("variant_weight", 1.0)))
+        if from_items:
+            embeddings.append(item["embedding"])
+
+    item_source_ids = np.asarray(item_source_ids, dtype=np.int32)
+
+    # Le varianti della stessa sorgente diventano colonne contigue:
+    # le riduzioni per sorgente si fanno con un solo reduceat.
+    order = np.argsort(item_source_ids, kind="stable").astype(np.int32)
+
+    if len(embeddings) == 0:
+        matrix = np.zeros((0, 0), dtype=np.float32)
+    elif from_items:
+        matrix = np.asarray(embeddings, dtype=np.float32)[order]
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        matrix = np.ascontiguousarray(matrix / np.maximum(norms, 1e-8), dtype=np.float32)
+    else:
+        matrix = embeddings
+        if not np.array_equal(order, np.arange(len(order))):
+            matrix = matrix[order]
+            if embedding_scales is not None:
+                embedding_scales = embedding_scales[order]
+    if embedding_scales is not None:
+        embedding_scales = np.asarray(embedding_scales, dtype=np.float32)
 
-def aggregate_waypoint_scores(best_by_source, view_names, top_k_per_waypoint=3, view_weights=None):
-    view_weights = view_weights or {}
-    by_waypoint = defaultdict(list)
+    variant_names = list(variant_ids.keys())
+    item_variant_ids = np.asarray(item_variant_ids, dtype=np.int32)[order]
+    original_variant_id = variant_ids.get("original", -1)
 
-    for (waypoint_name, _src), source_state in best_by_source.items():
-        by_waypoint[waypoint_name].append(source_state)
+    source_waypoint_ids = np.zeros(len(source_ids), dtype=np.int32)
+    for (waypoint_name, _src), source_id in source_ids.items():
+        source_waypoint_ids[source_id] = waypoint_ids[waypoint_name]
 
-    waypoint_stats = {}
-    for waypoint_name, source_states in by_waypoint.items():
-        source_states.sort(key=lambda s: s["best_score"], reverse=True)
-        top_sources = source_states[:top_k_per_waypoint]
+    sorted_waypoint_ids = np.asarray(item_waypoint_ids, dtype=np.int32)[order]
 
-        max_score = top_sources[0]["best_score"]
-        mean_score = sum(s["best_score"] for s in top_sources) / len(top_sources)
+    return {
+        "embeddings": matrix,
+        "embedding_scales": embedding_scales,
+        "item_positions": order,
+        "item_waypoint_ids": sorted_waypoint_ids,
+        "item_source_ids": item_source_ids[order],
+        "item_variant_ids": item_variant_ids,
+        "item_variant_weights": np.asarray(item_variant_weights, dtype=np.float32)[order],
+        "original_columns": np.flatnonzero(item_variant_ids == original_variant_id).astype(np.int32),
+        "source_waypoint_ids": source_waypoint_ids,
+        # Colonne raggruppate per waypoint: quelle del waypoint w sono
+        # waypoint_columns[waypoint_offsets[w]:waypoint_offsets[w + 1]]
+        "waypoint_columns": np.argsort(sorted_waypoint_ids, kind="stable").astype(np.int32),
+        "waypoint_offsets": np.r_[0, np.cumsum(np.bincount(sorted_waypoint_ids, minlength=len(waypoint_ids)))],
+        "source_keys": list(source_ids.keys()),
+        "waypoint_names": list(waypoint_ids.keys()),
+        "variant_names": variant_names,
+    }
 
-        per_view_best_scores = {}
-        for view_name in view_names:
-            per_view_best_scores[view_name] = max(
-                s["per_view_scores"].get(view_name, -1.0)
-                for s in top_sources
-            )
+def embedding_scores(queries, embedding_index, columns=None):
+    """
+    Prodotti scalari (viste, colonne) tra le query float32 e la matrice
+    dell'indice. Le matrici float16 / int8 si moltiplicano a blocchi senza
+    una copia float32 dell'intero indice; la scala int8 per riga si applica
+    al risultato: q . (c * s) = (q . c) * s.
+    """
+    matrix = embedding_index["embeddings"]
+    scales = embedding_index.get("embedding_scales")
+    if columns is not None:
+        matrix = matrix[columns]
+        scales = scales[columns] if scales is not None else None
+
+    if matrix.dtype == np.float32:
+        scores = queries @ matrix.T
+    else:
+        scores = np.empty((len(queries), len(matrix)), dtype=np.float32)
+        for start in range(0, len(matrix), EMBEDDING_SCORE_BLOCK_ROWS):
+            block = matrix[start:start + EMBEDDING_SCORE_BLOCK_ROWS]
+            scores[:, start:start + len(block)] = queries @ block.astype(np.float32).T
+
+    if scales is not None:
+        scores *= scales[None, :]
+    return scores
+
+def embedding_rows(embedding_index, columns):
+    """Righe float32 (de-quantizzate) dell'indice, per piccoli sottoinsiemi."""
+    rows = np.asarray(embedding_index["embeddings"][columns], dtype=np.float32)
+    scales = embedding_index.get("embedding_scales")
+    if scales is not None:
+        rows = rows * scales[columns][:, None]
+    return rows
+
+def segment_starts(sorted_ids):
+    if len(sorted_ids) == 0:
+        return np.zeros(0, dtype=np.int64)
+    return np.flatnonzero(np.r_[True, sorted_ids[1:] != sorted_ids[:-1]])
+
+def reduce_scores_by_source(weighted_scores, columns, embedding_index):
+    """
+    weighted_scores: (viste, len(columns)) con columns crescenti, quindi
+    raggruppate per sorgente. Restituisce per ogni sorgente il miglior
+    punteggio, il massimo per vista e la colonna dell'item migliore.
+    """
+    source_ids = embedding_index["item_source_ids"][columns]
+    starts = segment_starts(source_ids)
+
+    per_view_scores = np.maximum.reduceat(weighted_scores, starts, axis=1)
+    item_best = weighted_scores.max(axis=0)
+    best_scores = np.maximum.reduceat(item_best, starts)
+
+    segment = np.repeat(np.arange(len(starts)), np.diff(np.r_[starts, len(columns)]))
+    hits = np.flatnonzero(item_best == best_scores[segment])
+    _, first_hit = np.unique(segment[hits], return_index=True)
 
-        waypoint_stats[waypoint_name] = {
-            "waypoint_name": waypoint_name,
-            "max_score": max_score,
-            "mean_score": mean_score,
-            "per_view_best_scores": per_view_best_scores,
-            "items": [s["best_item"] for s in top_sources],
-        }
+    return {
+        "source_ids": source_ids[starts],
+        "best_scores": best_scores,
+        "per_view_scores": per_view_scores,
+        "best_columns": columns[hits[first_hit]],
+    }
 
-    view_winners = {}
-    for view_name in view_names:
-        best_waypoint = None
-        best_score = -1.0
-        for waypoint_name, stats in waypoint_stats.items():
-            score = stats["per_view_best_scores"][view_name]
-            if score > best_score:
-                best_score = score
-                best_waypoint = waypoint_name
-        view_winners[view_name] = best_waypoint
+def aggregate_waypoint_scores(
+    source_scores,
+    embedding_index,
+    waypoint_index,
+    view_names,
+    top_k_per_waypoint=3,
+    view_weights=None,
+):
+    view_weights = view_weights or {}
 
-    ranked = []
-    total_view_weight = sum(view_weights.get(v, 1.0) for v in view_names) or 1.0
+    best_scores = source_scores["best_scores"]
+    if len(best_scores) == 0:
+        return []
+
+    waypoint_ids = embedding_index["source_waypoint_ids"][source_scores["source_ids"]]
+
+    # Ordina le sorgenti per waypoint e, dentro ogni waypoint, per punteggio
+    # decrescente; tiene solo le prime top_k_per_waypoint.
+    order = np.lexsort((-best_scores, waypoint_ids))
+    sorted_waypoints = waypoint_ids[order]
+    starts = segment_starts(sorted_waypoints)
+    rank_in_waypoint = np.arange(len(order)) - np.repeat(starts, np.diff(np.r_[starts, len(order)]))
+    kept = order[rank_in_waypoint < top_k_per_waypoint]
+
+    kept_waypoints = waypoint_ids[kept]
+    kept_starts = segment_starts(kept_waypoints)
+    kept_counts = np.diff(np.r_[kept_starts, len(kept)])
+    kept_scores = best_scores[kept]
+
+    max_scores = kept_scores[kept_starts]
+    mean_scores = np.add.reduceat(kept_scores, kept_starts) / kept_counts
+    per_view_best_scores = np.maximum.reduceat(
+        source_scores["per_view_scores"][:, kept], kept_starts, axis=1
+    )
 
-    for waypoint_name, stats in waypoint_stats.items():
-        view_vote_count = sum(
-            1 for winner in view_winners.values()
-            if winner == waypoint_name
-        )
-        view_vote_weight = sum(
-            view_weights.get(view_name, 1.0)
-            for view_name, winner in view_winners.items()
-            if winner == waypoint_name
-        )
-        view_vote_ratio = view_vote_weight / total_view_weight
+    view_weight_array = np.asarray(
+        [float(view_weights.get(v, 1.0)) for v in view_names], dtype=np.float32
+    )
+    total_view_weight = float(view_weight_array.sum()) or 1.0
+
+    n_waypoints = len(kept_starts)
+    view_winners = np.argmax(per_view_best_scores, axis=1)
+    view_vote_counts = np.bincount(view_winners, minlength=n_waypoints)
+    view_vote_ratios = np.bincount(
+        view_winners, weights=view_weight_array, minlength=n_waypoints
+    ) / total_view_weight
+
+    consensus_scores = (
+        0.55 * max_scores +
+        0.25 * mean_scores +
+        0.20 * view_vote_ratios
+    )
 
-        consensus_score = (
-            0.55 * stats["max_score"] +
-            0.25 * stats["mean_score"] +
-            0.20 * view_vote_ratio
-        )
+    item_positions = embedding_index["item_positions"]
+    best_columns = source_scores["best_columns"][kept]
+    waypoint_names = embedding_index["waypoint_names"]
 
+    ranked = []
+    for i, start in enumerate(kept_starts):
+        waypoint_id = int(kept_waypoints[start])
         ranked.append({
-            "waypoint_name": waypoint_name,
-            "consensus_score": consensus_score,
-            "max_score": stats["max_score"],
-            "mean_score": stats["mean_score"],
-            "view_vote_count": view_vote_count,
-            "view_vote_ratio": view_vote_ratio,
-            "items": stats["items"],
+            "waypoint_id": waypoint_id,
+            "waypoint_name": waypoint_names[waypoint_id],
+            "consensus_score": float(consensus_scores[i]),
+            "max_score": float(max_scores[i]),
+            "mean_score": float(mean_scores[i]),
+            "view_vote_count": int(view_vote_counts[i]),
+            "view_vote_ratio": float(view_vote_ratios[i]),
+            "items": [
+                waypoint_index[item_positions[col]]
+                for col in best_columns[start:start + kept_counts[i]]
+            ],
         })
 
     ranked.sort(key=lambda x: x["consensus_score"], reverse=True)
@@ -180,35 +875,48 @@ def l2_normalize_np(vec):
         return vec
     return vec / norm
 
-def compute_waypoint_centroids(index):
-    by_waypoint = defaultdict(list)
-    seen = set()
-    
-    for item in index:
-        waypoint_name = item['waypoint_name']
-        source_image_path = item.get('source_image_path', item['image_path'])
-        variant_name = item.get('variant_name', 'original')
-        
-        if variant_name != 'original':
+def compute_waypoint_centroids(embedding_index):
+    """
+    Centroide L2-normalizzato degli originali di ogni waypoint, come matrice
+    (W, D) allineata a waypoint_names. Una sola immagine originale per sorgente.
+    """
+    matrix = embedding_index["embeddings"]
+    n_waypoints = len(embedding_index["waypoint_names"])
+    centroids = np.zeros((n_waypoints, matrix.shape[1]), dtype=np.float32)
+
+    first_per_source = original_columns_per_source(embedding_index)
+
+    if len(first_per_source) == 0:
+        return centroids
+
+    waypoint_ids = embedding_index["item_waypoint_ids"][first_per_source]
+    np.add.at(centroids, waypoint_ids, embedding_rows(embedding_index, first_per_source))
+
+    norms = np.linalg.norm(centroids, axis=1, keepdims=True)
+    return np.ascontiguousarray(centroids / np.maximum(norms, 1e-8), dtype=np.float32)
+
+def build_geometry_reference_lookup(waypoint_index):
+    """
+    Tabelle costruite una volta per contesto del tour:
+    - "by_source": (waypoint, immagine sorgente) -> primo originale usabile
+      per la geometria;
+    - "by_waypoint": waypoint -> riferimenti nell'ordine dell'indice.
+    """
+    by_source = {}
+    by_waypoint = {}
+    for item in waypoint_index:
+        if item.get("variant_name", "original") != "original" or not item.get("use_for_geometry", True):
             continue
-        
-        key = (waypoint_name, source_image_path)
-        if key in seen:
+        key = reference_key(item)
+        if key in by_source:
             continue
-        
-        seen.add(key)
-        
-        emb = np.asarray(item['embedding'], dtype=np.float32)
-        by_waypoint[waypoint_name].append(emb)
-        
-    centroids = {}
-    for waypoint_name, embeddings in by_waypoint.items():
-        centroid = np.mean(np.stack(embeddings, axis=0), axis=0)
-        centroids[waypoint_name] = l2_normalize_np(centroid)
-        
-    return centroids
+        by_source[key] = item
+        by_waypoint.setdefault(item["waypoint_name"], []).append(item)
 
-def get_geometry_reference_items(waypoint_name, ranked_items, full_index, limit=5):
+    return {"by_source": by_source, "by_waypoint": by_waypoint}
+
+def get_geometry_reference_items(waypoint_name, ranked_items, references, limit=5):
+    by_source = references["by_source"]
     seen_sources = set()
     refs = []
 
@@ -218,193 +926,398 @@ def get_geometry_reference_items(waypoint_name, ranked_items, full_index, limit=
             continue
         seen_sources.add(src)
 
-        for ref in full_index:
-            if (
-                ref["waypoint_name"] == waypoint_name
-                and ref.get("source_image_path", ref["image_path"]) == src
-                and ref.get("variant_name", "original") == "original"
-                and ref.get("use_for_geometry", True)
-            ):
-                refs.append(ref)
-                break
+        ref = by_source.get((waypoint_name, src))
+        if ref is not None:
+            refs.append(ref)
 
         if len(refs) >= limit:
             break
 
     return refs
 
-def verify_match_geometric(query_path, candidate_item):
-    try:
-        img1 = cv2.imread(query_path, cv2.IMREAD_COLOR)
-        if img1 is None:
-            return False, 0, 0.0
+def decode_reference_geometry(waypoint_index):
+    """
+    Decodifica una sola volta, al caricamento dell'indice JSON, i descrittori
+    ORB base64 e i keypoint dei riferimenti in due blocchi contigui. Ogni
+    riferimento riceve "descriptors" / "keypoint_coords" come viste sui
+    blocchi e perde le copie JSON. Gli item dell'indice binario hanno gia'
+    le viste sul memmap e non vengono toccati.
+    """
+    decoded = []
+    for item in waypoint_index:
+        if "descriptors" in item or not item.get("descriptors_b64"):
+            continue
 
-        des2 = decode_descriptors_from_base64(
-            candidate_item.get("descriptors_b64", ""),
-            int(candidate_item.get("desc_rows", 0)),
-            int(candidate_item.get("desc_cols", 0)),
+        descriptors = decode_descriptors_from_base64(
+            item["descriptors_b64"],
+            int(item.get("desc_rows", 0)),
+            int(item.get("desc_cols", 0)),
         )
-        if des2 is None:
-            return False, 0, 0.0
+        if descriptors is None:
+            continue
 
-        orb_query = build_orb_input_from_bgr(
-            img1,
-            use_clahe=True,
-            use_edges=False,
-            canny_low=80,
-            canny_high=160,
-            edge_alpha=0.25,
-        )
+        keypoint_coords = np.float32(
+            [[p[0][0], p[0][1]] for p in item.get("keypoints", [])]
+        ).reshape(-1, 2)
+        decoded.append((item, descriptors, keypoint_coords))
+
+    if not decoded:
+        return {
+            "descriptors": np.zeros((0, 32), dtype=np.uint8),
+            "keypoints": np.zeros((0, 2), dtype=np.float32),
+        }
+
+    descriptor_block = np.concatenate([d for _, d, _ in decoded], axis=0)
+    keypoint_block = np.concatenate([k for _, _, k in decoded], axis=0)
 
-        kp2 = [
-            cv2.KeyPoint(
-                x=float(p[0][0]),
-                y=float(p[0][1]),
-                size=31,
-                angle=0,
-                response=0,
-                octave=0,
-                class_id=0,
+    d0 = k0 = 0
+    for item, descriptors, keypoint_coords in decoded:
+        d1 = d0 + len(descriptors)
+        k1 = k0 + len(keypoint_coords)
+        item["descriptors"] = descriptor_block[d0:d1]
+        item["keypoint_coords"] = keypoint_block[k0:k1]
+        item.pop("descriptors_b64", None)
+        item.pop("keypoints", None)
+        d0, k0 = d1, k1
+
+    return {
+        "descriptors": descriptor_block,
+        "keypoints": keypoint_block,
+    }
+
+def reference_geometry(candidate_item):
+    """
+    Descrittori ORB (rows, cols) uint8 e coordinate keypoint (rows, 2) di un
+    riferimento, gia' decodificati da prepare_index_content.
+    """
+    return candidate_item.get("descriptors"), candidate_item.get("keypoint_coords")
+
+def reference_key(item):
+    return (item["waypoint_name"], item.get("source_image_path", item["image_path"]))
+
+def is_geometry_reference(item):
+    descriptors, _keypoints = reference_geometry(item)
+    return (
+        item.get("variant_name", "original") == "original"
+        and item.get("use_for_geometry", True)
+        and descriptors is not None
+        and len(descriptors) >= 2
+    )
+
+class PrebuiltMatcher:
+    """
+    Matcher OpenCV addestrato una volta sui descrittori di uno o piu'
+    riferimenti, condiviso tra le richieste che usano lo stesso contesto
+    del tour. knnMatch e' serializzato solo se il matcher non e' thread-safe
+    (FLANN); il BFMatcher addestrato e' in sola lettura e va in parallelo.
+    """
+
+    def __init__(self, matcher, descriptors_list, thread_safe=False):
+        self.matcher = matcher
+        self.matcher.add([np.ascontiguousarray(d) for d in descriptors_list])
+        self.matcher.train()
+        self.lock = None if thread_safe else threading.Lock()
+        # Copia dei descrittori tenuta dal matcher (vedi context_nbytes)
+        self.nbytes = sum(d.nbytes for d in descriptors_list)
+
+    def knn_match(self, query_descriptors, k=2):
+        if self.lock is None:
+            return self.matcher.knnMatch(query_descriptors, k=k)
+        with self.lock:
+            return self.matcher.knnMatch(query_descriptors, k=k)
+
+def create_flann_lsh_matcher():
+    return cv2.FlannBasedMatcher(FLANN_LSH_INDEX_PARAMS, FLANN_LSH_SEARCH_PARAMS)
+
+def build_geometry_matchers(waypoint_index, backend=GEOMETRY_MATCHER_BACKEND):
+    """
+    Matcher dei descrittori costruiti una volta per contesto del tour:
+    - "bf": BFMatcher Hamming per thread, nessuno stato per riferimento;
+    - "flann_lsh": un indice FLANN LSH per riferimento;
+    - "bf_waypoint": un BFMatcher per waypoint con tutti i suoi riferimenti
+      (add/train), interrogato una volta per candidato.
+    """
+    if backend not in GEOMETRY_MATCHER_BACKENDS:
+        raise ValueError(f"Matcher geometrico non supportato: {backend}")
+
+    matchers = {"backend": backend, "by_reference": {}, "by_waypoint": {}}
+    if backend == "bf":
+        return matchers
+
+    references = [item for item in waypoint_index if is_geometry_reference(item)]
+
+    if backend == "flann_lsh":
+        for item in references:
+            matchers["by_reference"][reference_key(item)] = PrebuiltMatcher(
+                create_flann_lsh_matcher(),
+                [reference_geometry(item)[0]],
             )
-            for p in candidate_item["keypoints"]
-        ]
+        return matchers
+
+    by_waypoint = {}
+    for item in references:
+        by_waypoint.setdefault(item["waypoint_name"], []).append(item)
+
+    for waypoint_name, items in by_waypoint.items():
+        matchers["by_waypoint"][waypoint_name] = {
+            "matcher": PrebuiltMatcher(
+                cv2.BFMatcher(cv2.NORM_HAMMING),
+                [reference_geometry(item)[0] for item in items],
+                thread_safe=True,
+            ),
+            "reference_keys": [reference_key(item) for item in items],
+        }
+    return matchers
+
+def ratio_test(matches):
+    good_matches = []
+    for pair in matches:
+        if len(pair) < 2:
+            continue
+        m, n = pair[0], pair[1]
+        if m.distance < RATIO_TEST_THRESHOLD * n.distance:
+            good_matches.append(m)
+    return good_matches
+
+def waypoint_ratio_test(matches, reference_keys, k=WAYPOINT_MATCHER_KNN):
+    """
+    Ratio test sui vicini di un matcher multi-immagine: il secondo vicino
+    e' il primo della stessa immagine del migliore. Se non compare tra i k
+    vicini, il k-esimo e' un limite inferiore e basta per accettare.
+    """
+    good_by_reference = {}
+    for neighbours in matches:
+        if len(neighbours) < 2:
+            continue
+        m = neighbours[0]
+        second = next((n for n in neighbours[1:] if n.imgIdx == m.imgIdx), None)
+        if second is None and len(neighbours) < k:
+            continue
+        bound = second.distance if second is not None else neighbours[-1].distance
+        if m.distance < RATIO_TEST_THRESHOLD * bound:
+            good_by_reference.setdefault(reference_keys[m.imgIdx], []).append(m)
+    return good_by_reference
 
-        orb = cv2.ORB_create(nfeatures=5000, fastThreshold=10)
-        kp1, des1 = orb.detectAndCompute(orb_query, None)
+def geometry_from_matches(good_matches, kp1, kp2):
+    if len(good_matches) < 4:
+        return False, len(good_matches), 0.0
 
-        if des1 is None or len(des1) < 2 or len(des2) < 2:
-            return False, 0, 0.0
+    good_matches = sorted(good_matches, key=lambda x: x.distance)
+    top_matches = good_matches[:TOP_MATCHES_FOR_RANSAC]
 
-        bf = cv2.BFMatcher(cv2.NORM_HAMMING)
-        matches = bf.knnMatch(des1, des2, k=2)
+    if len(top_matches) < 4:
+        return False, len(top_matches), 0.0
 
-        good_matches = []
-        for pair in matches:
-            if len(pair) < 2:
-                continue
-            m, n = pair
-            if m.distance < RATIO_TEST_THRESHOLD * n.distance:
-                good_matches.append(m)
+    src_pts = kp1[[m.queryIdx for m in top_matches]].reshape(-1, 1, 2)
+    dst_pts = kp2[[m.trainIdx for m in top_matches]].reshape(-1, 1, 2)
 
-        if len(good_matches) < 4:
-            return False, len(good_matches), 0.0
-        
-        good_matches.sort(key=lambda x: x.distance)
-        top_matches = good_matches[:TOP_MATCHES_FOR_RANSAC]
-        
-        if len(top_matches) < 4:
-            return False, len(top_matches), 0.0
+    M, mask = cv2.findHomography(src_pts, dst_pts, cv2.RANSAC, 5.0)
+    if M is None or mask is None:
+        return False, 0, 0.0
 
-        src_pts = np.float32([kp1[m.queryIdx].pt for m in top_matches]).reshape(-1, 1, 2)
-        dst_pts = np.float32([kp2[m.trainIdx].pt for m in top_matches]).reshape(-1, 1, 2)
+    inlier_count = int(np.sum(mask))
+    inlier_ratio = inlier_count / max(len(top_matches), 1)
 
-        M, mask = cv2.findHomography(src_pts, dst_pts, cv2.RANSAC, 5.0)
-        if M is None or mask is None:
+    passed = (
+        (inlier_count >= 8 and inlier_ratio >= 0.08)
+        or
+        (inlier_count >= 15)
+        or
+        (inlier_count >= 10 and inlier_ratio >= 0.05)
+    )
+    return passed, inlier_count, inlier_ratio
+
+def verify_match_geometric(query_image, candidate_item, matcher=None):
+    try:
+        des2, kp2 = reference_geometry(candidate_item)
+        if des2 is None:
             return False, 0, 0.0
 
-        inlier_count = int(np.sum(mask))
-        inlier_ratio = inlier_count / max(len(top_matches), 1)
-        
-        passed = (
-            (inlier_count >= 8 and inlier_ratio >= 0.08)
-            or
-            (inlier_count >= 15)
-            or
-            (inlier_count >= 10 and inlier_ratio >= 0.05)
-        )
-        return passed, inlier_count, inlier_ratio
+        kp1, des1 = query_image.orb_features()
+
+        if des1 is None or len(des1) < 2 or len(des2) < 2:
+            return False, 0, 0.0
+
+        if matcher is not None:
+            matches = matcher.knn_match(des1, k=2)
+        else:
+            matches = thread_bf_matcher().knnMatch(des1, des2, k=2)
+
+        return geometry_from_matches(ratio_test(matches), kp1, kp2)
 
     except Exception as e:
         print(f"Errore durante la verifica geometrica: {e}")
         return False, 0, 0.0
 
+def verify_waypoint_references(query_image, refs, waypoint_matcher):
+    try:
+        kp1, des1 = query_image.orb_features()
+        if des1 is None or len(des1) < 2:
+            return [(False, 0, 0.0) for _ in refs]
+
+        matches = waypoint_matcher["matcher"].knn_match(des1, k=WAYPOINT_MATCHER_KNN)
+        good_by_reference = waypoint_ratio_test(matches, waypoint_matcher["reference_keys"])
+
+        return [
+            geometry_from_matches(
+                good_by_reference.get(reference_key(ref), []),
+                kp1,
+                reference_geometry(ref)[1],
+            )
+            for ref in refs
+        ]
+
+    except Exception as e:
+        print(f"Errore durante la verifica geometrica: {e}")
+        return [(False, 0, 0.0) for _ in refs]
+
+
+def ann_candidate_columns(
+    queries,
+    view_weight_array,
+    embedding_index,
+    ann_index,
+    n_probe=ANN_N_PROBE,
+    top_sources=ANN_TOP_SOURCES,
+):
+    """
+    Colonne candidate dall'indice IVF: le righe delle liste sondate danno il
+    miglior punteggio per sorgente; delle prime top_sources sorgenti si
+    restituiscono tutte le colonne (crescenti), da ri-valutare in modo esatto.
+    """
+    item_source_ids = embedding_index["item_source_ids"]
+
+    rows = ann_index.probe(queries, n_probe)
+    row_scores = (
+        embedding_scores(queries, embedding_index, rows) *
+        view_weight_array[:, None] *
+        embedding_index["item_variant_weights"][rows][None, :]
+    ).max(axis=0)
+
+    source_scores = reduce_scores_by_source(row_scores[None, :], rows, embedding_index)
+    source_ids = source_scores["source_ids"]
+    if len(source_ids) > top_sources:
+        keep = np.argpartition(-source_scores["best_scores"], top_sources - 1)[:top_sources]
+        source_ids = np.sort(source_ids[keep])
+
+    # Colonne ordinate per sorgente: ogni sorgente e' un intervallo contiguo
+    starts = np.searchsorted(item_source_ids, source_ids, side="left")
+    ends = np.searchsorted(item_source_ids, source_ids, side="right")
+    return np.concatenate([
+        np.arange(start, end, dtype=np.int32) for start, end in zip(starts, ends)
+    ])
+
+def columns_of_waypoints(embedding_index, waypoint_ids):
+    """Colonne (crescenti) dell'indice che appartengono ai waypoint dati."""
+    offsets = embedding_index["waypoint_offsets"]
+    columns = embedding_index["waypoint_columns"]
+    blocks = [columns[offsets[i]:offsets[i + 1]] for i in waypoint_ids]
+    return np.sort(np.concatenate(blocks)) if blocks else np.zeros(0, dtype=np.int32)
+
+def centroid_shortlist(
+    queries,
+    view_weight_array,
+    centroids,
+    top_waypoints=HIERARCHICAL_TOP_WAYPOINTS,
+    margin=HIERARCHICAL_CENTROID_MARGIN,
+):
+    """
+    Id (crescenti) dei waypoint da valutare per item: i primi top_waypoints
+    per similarita' con il centroide, piu' quelli entro margin dall'ultimo.
+    I waypoint senza originali (centroide nullo) restano sempre.
+    """
+    centroid_scores = ((queries @ centroids.T) * view_weight_array[:, None]).max(axis=0)
+    if len(centroid_scores) <= top_waypoints:
+        return np.arange(len(centroid_scores), dtype=np.int32)
+
+    cutoff = -np.partition(-centroid_scores, top_waypoints - 1)[top_waypoints - 1]
+    keep = (centroid_scores >= cutoff - margin) | ~centroids.any(axis=1)
+    return np.flatnonzero(keep).astype(np.int32)
 
 def rank_waypoints_by_similarity(
     query_embeddings,
-    index,
+    embedding_index,
+    waypoint_index,
     top_k_per_waypoint=3,
     centroids=None,
     view_weights=None,
+    ann_index=None,
+    columns=None,
+    hierarchical=False,
 ):
+    """
+    Classifica i waypoint per similarita' visiva. `columns` (crescenti)
+    limita la valutazione a un sottoinsieme dell'indice, ad esempio i
+    waypoint vicini del prefiltro GPS; senza, con `hierarchical` si valutano
+    solo i waypoint scelti dai centroidi (centroid_shortlist), altrimenti si
+    usa l'indice ANN se c'e'.
+    """
     view_names = list(query_embeddings.keys())
     view_weights = view_weights or {}
 
-    best_by_source_all = {}
-    best_by_source_original = {}
+    matrix = embedding_index["embeddings"]
+    if matrix.shape[0] == 0:
+        return []
 
-    for item in index:
-        waypoint_name = item["waypoint_name"]
-        source_image_path = item.get("source_image_path", item["image_path"])
-        source_key = (waypoint_name, source_image_path)
-
-        item_emb = np.asarray(item["embedding"], dtype=np.float32)
-        variant_weight = float(item.get("variant_weight", 1.0))
-        variant_name = item.get("variant_name", "original")
+    queries = np.stack([l2_normalize_np(q) for q in query_embeddings.values()])
+    view_weight_array = np.asarray(
+        [float(view_weights.get(v, 1.0)) for v in view_names], dtype=np.float32
+    )
 
-        per_view_scores = {}
-        best_score = -1.0
+    # Con colonne date, ranking gerarchico o indice ANN si valutano solo le
+    # colonne candidate, altrimenti tutto l'indice; i punteggi sono esatti.
+    if columns is None and hierarchical and centroids is not None and len(centroids) > 0:
+        columns = columns_of_waypoints(
+            embedding_index, centroid_shortlist(queries, view_weight_array, centroids)
+        )
+    if columns is None and ann_index is not None:
+        columns = ann_candidate_columns(queries, view_weight_array, embedding_index, ann_index)
+    if columns is not None:
+        columns = np.asarray(columns, dtype=np.int32)
+        original_mask = np.isin(columns, embedding_index["original_columns"])
+    else:
+        columns = np.arange(matrix.shape[0], dtype=np.int32)
+        original_mask = None
+
+    # (viste x colonne): un'unica moltiplicazione matriciale
+    weighted_scores = (
+        embedding_scores(queries, embedding_index, None if original_mask is None else columns) *
+        view_weight_array[:, None] *
+        embedding_index["item_variant_weights"][columns][None, :]
+    )
 
-        for view_name, q_emb in query_embeddings.items():
-            raw_score = cosine_similarity_np(q_emb, item_emb)
-            weighted_score = (
-                raw_score *
-                variant_weight *
-                float(view_weights.get(view_name, 1.0))
-            )
-            per_view_scores[view_name] = weighted_score
-            best_score = max(best_score, weighted_score)
-
-        current = best_by_source_all.get(source_key)
-        if current is None:
-            best_by_source_all[source_key] = {
-                "best_score": best_score,
-                "best_item": item,
-                "per_view_scores": per_view_scores,
-            }
-        else:
-            for view_name, score in per_view_scores.items():
-                current["per_view_scores"][view_name] = max(
-                    current["per_view_scores"].get(view_name, -1.0),
-                    score,
-                )
-            if best_score > current["best_score"]:
-                current["best_score"] = best_score
-                current["best_item"] = item
-
-        if variant_name == "original":
-            current_orig = best_by_source_original.get(source_key)
-            if current_orig is None:
-                best_by_source_original[source_key] = {
-                    "best_score": best_score,
-                    "best_item": item,
-                    "per_view_scores": per_view_scores,
-                }
-            else:
-                for view_name, score in per_view_scores.items():
-                    current_orig["per_view_scores"][view_name] = max(
-                        current_orig["per_view_scores"].get(view_name, -1.0),
-                        score,
-                    )
-                if best_score > current_orig["best_score"]:
-                    current_orig["best_score"] = best_score
-                    current_orig["best_item"] = item
+    if original_mask is None:
+        original_columns = embedding_index["original_columns"]
+        original_scores = weighted_scores[:, original_columns]
+    else:
+        original_columns = columns[original_mask]
+        original_scores = weighted_scores[:, original_mask]
 
     ranked_all = aggregate_waypoint_scores(
-        best_by_source_all,
+        reduce_scores_by_source(weighted_scores, columns, embedding_index),
+        embedding_index,
+        waypoint_index,
         view_names,
         top_k_per_waypoint=top_k_per_waypoint,
         view_weights=view_weights,
     )
 
-    ranked_original = aggregate_waypoint_scores(
-        best_by_source_original,
-        view_names,
-        top_k_per_waypoint=top_k_per_waypoint,
-        view_weights=view_weights,
-    )
+    ranked_original = []
+    if len(original_columns) > 0:
+        ranked_original = aggregate_waypoint_scores(
+            reduce_scores_by_source(original_scores, original_columns, embedding_index),
+            embedding_index,
+            waypoint_index,
+            view_names,
+            top_k_per_waypoint=top_k_per_waypoint,
+            view_weights=view_weights,
+        )
 
     original_by_name = {r["waypoint_name"]: r for r in ranked_original}
-    centroids = centroids or {}
+
+    centroid_scores = None
+    if centroids is not None and len(centroids) > 0:
+        centroid_scores = ((queries @ centroids.T) * view_weight_array[:, None]).max(axis=0)
 
     final_ranked = []
     for item in ranked_all:
@@ -418,12 +1331,8 @@ def rank_waypoints_by_similarity(
         })
 
         centroid_score = 0.0
-        centroid = centroids.get(waypoint_name)
-        if centroid is not None:
-            centroid_score = max(
-                cosine_similarity_np(q_emb, centroid) * float(view_weights.get(view_name, 1.0))
-                for view_name, q_emb in query_embeddings.items()
-            )
+        if centroid_scores is not None and waypoint_name in original_by_name:
+            centroid_score = float(centroid_scores[item["waypoint_id"]])
 
         final_score = (
             0.55 * original_stats["consensus_score"] +
@@ -452,46 +1361,29 @@ def clamp(value, lo, hi):
     return max(lo, min(hi, value))
 
 
-def percentile_safe(values, q, default):
-    if not values:
-        return default
-    return float(np.percentile(np.asarray(values, dtype=np.float32), q))
-
-
-def calibrate_index_from_originals(index):
-    originals = []
-    seen = set()
-
-    for item in index:
-        if item.get("variant_name", "original") != "original":
-            continue
-
-        waypoint_name = item["waypoint_name"]
-        source = item.get("source_image_path", item["image_path"])
-        key = (waypoint_name, source)
-        if key in seen:
-            continue
-        seen.add(key)
-
-        originals.append({
-            "waypoint_name": waypoint_name,
-            "embedding": l2_normalize_np(np.asarray(item["embedding"], dtype=np.float32)),
-        })
-
-    positive_scores = []
-    negative_scores = []
-
-    for i in range(len(originals)):
-        for j in range(i + 1, len(originals)):
-            s = cosine_similarity_np(originals[i]["embedding"], originals[j]["embedding"])
-            if originals[i]["waypoint_name"] == originals[j]["waypoint_name"]:
-                positive_scores.append(s)
-            else:
-                negative_scores.append(s)
+def original_columns_per_source(embedding_index):
+    """Colonna della prima immagine originale di ogni sorgente."""
+    original_columns = embedding_index["original_columns"]
+    source_ids = embedding_index["item_source_ids"][original_columns]
+    return original_columns[segment_starts(source_ids)]
+
+def calibrate_index_from_originals(embedding_index, calibration_stats=None):
+    """
+    Soglie calibrate sui percentili delle similarita' negative tra originali.
+    calibration_stats arriva gia' calcolato dall'indice binario (training);
+    altrimenti si ricava qui dalla matrice degli embedding.
+    """
+    if calibration_stats is None:
+        columns = original_columns_per_source(embedding_index)
+        calibration_stats = negative_similarity_percentiles(
+            embedding_rows(embedding_index, columns),
+            embedding_index["item_waypoint_ids"][columns],
+        )
+    calibration_stats = calibration_stats or {}
 
-    neg_p90 = percentile_safe(negative_scores, 90, 0.54)
-    neg_p95 = percentile_safe(negative_scores, 95, 0.58)
-    neg_p99 = percentile_safe(negative_scores, 99, 0.64)
+    neg_p90 = float(calibration_stats.get("negative_p90", 0.54))
+    neg_p95 = float(calibration_stats.get("negative_p95", 0.58))
+    neg_p99 = float(calibration_stats.get("negative_p99", 0.64))
 
     return {
         "negative_p90": neg_p90,
@@ -503,19 +1395,9 @@ def calibrate_index_from_originals(index):
     }
 
 
-def assess_image_quality(image_path):
-    img = cv2.imread(str(image_path), cv2.IMREAD_COLOR)
-    if img is None:
-        return {
-            "blur_var": 0.0,
-            "brightness": 0.0,
-            "contrast": 0.0,
-            "threshold_bump": 0.04,
-            "flags": ["unreadable"],
-        }
-
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    blur_var = float(cv2.Laplacian(gray, cv2.CV_64F).var())
+def assess_image_quality(query_image):
+    gray = query_image.gray
+    blur_var = query_image.blur_var
     brightness = float(np.mean(gray))
     contrast = float(np.std(gray))
 
@@ -552,37 +1434,129 @@ def assess_image_quality(image_path):
     }
 
 
-def verify_candidate_geometry(query_path, candidate, full_index, limit=GEOMETRY_TOP_REFS):
-    refs = get_geometry_reference_items(
-        candidate["waypoint_name"],
-        candidate.get("items", []),
-        full_index,
-        limit=limit,
-    )
+def is_strong_geometry(inliers, ratio):
+    return inliers >= GEOMETRY_STRONG_INLIERS and ratio >= GEOMETRY_STRONG_RATIO
 
-    best = {
-        "passed": False,
-        "strong": False,
-        "inliers": 0,
-        "ratio": 0.0,
-        "refs_checked": len(refs),
+def get_geometry_executor():
+    global _GEOMETRY_EXECUTOR
+    with _GEOMETRY_EXECUTOR_LOCK:
+        if _GEOMETRY_EXECUTOR is None:
+            _GEOMETRY_EXECUTOR = ThreadPoolExecutor(
+                max_workers=GEOMETRY_MAX_WORKERS,
+                thread_name_prefix="geometry",
+            )
+        return _GEOMETRY_EXECUTOR
+
+def verify_single_reference(query_image, ref, matcher=None):
+    return [verify_match_geometric(query_image, ref, matcher=matcher)]
+
+def verify_candidates_geometry(query_image, candidates, references, limit=GEOMETRY_TOP_REFS, matchers=None, timings=None):
+    """
+    Verifica geometrica di piu' candidati in parallelo: ogni coppia
+    (candidato, riferimento) e' un task del pool condiviso (matching e
+    findHomography rilasciano il GIL). "strong" vale se un riferimento
+    qualsiasi supera la soglia (indipendente dal riferimento con piu'
+    inlier e dall'ordine di completamento): da quel momento i riferimenti
+    ancora in coda dello stesso candidato vengono cancellati. Con timings, timings["geometry_candidate"] riceve
+    i secondi di verifica spesi su ciascun candidato.
+    """
+    matchers = matchers or {}
+    by_waypoint = matchers.get("by_waypoint", {})
+    by_reference = matchers.get("by_reference", {})
+
+    results = []
+    tasks = []
+    for candidate_idx, candidate in enumerate(candidates):
+        refs = get_geometry_reference_items(
+            candidate["waypoint_name"],
+            candidate.get("items", []),
+            references,
+            limit=limit,
+        )
+        results.append({
+            "passed": False,
+            "strong": False,
+            "inliers": 0,
+            "ratio": 0.0,
+            "refs_checked": len(refs),
+        })
+        if not refs:
+            continue
+
+        waypoint_matcher = by_waypoint.get(candidate["waypoint_name"])
+        if waypoint_matcher is not None:
+            # Una sola interrogazione del matcher per tutti i riferimenti
+            tasks.append((candidate_idx, verify_waypoint_references, (query_image, refs, waypoint_matcher)))
+        else:
+            for ref in refs:
+                matcher = by_reference.get(reference_key(ref))
+                tasks.append((candidate_idx, verify_single_reference, (query_image, ref, matcher)))
+
+    # Feature della query estratte una volta prima di distribuire i task
+    if tasks:
+        query_image.orb_features()
+
+    task_seconds = []
+
+    def run_task(candidate_idx, fn, args):
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            task_seconds.append((candidate_idx, time.perf_counter() - start))
+
+    def record_timings():
+        if timings is None:
+            return
+        per_candidate = [0.0] * len(candidates)
+        for candidate_idx, seconds in list(task_seconds):
+            per_candidate[candidate_idx] += seconds
+        timings.setdefault("geometry_candidate", []).extend(
+            seconds for seconds, result in zip(per_candidate, results) if result["refs_checked"]
+        )
+
+    def update_best(candidate_idx, ref_results):
+        best = results[candidate_idx]
+        for passed, inliers, ratio in ref_results:
+            if inliers > best["inliers"] or (inliers == best["inliers"] and ratio > best["ratio"]):
+                best.update({
+                    "passed": passed,
+                    "inliers": inliers,
+                    "ratio": ratio,
+                })
+            # OR persistente: non dipende da quale riferimento ha piu' inlier
+            best["strong"] = best["strong"] or is_strong_geometry(inliers, ratio)
+        return best["strong"]
+
+    if GEOMETRY_MAX_WORKERS <= 1 or len(tasks) <= 1:
+        for candidate_idx, fn, args in tasks:
+            if not results[candidate_idx]["strong"]:
+                update_best(candidate_idx, run_task(candidate_idx, fn, args))
+        record_timings()
+        return results
+
+    executor = get_geometry_executor()
+    futures = {
+        executor.submit(run_task, candidate_idx, fn, args): candidate_idx
+        for candidate_idx, fn, args in tasks
     }
 
-    for ref in refs:
-        passed, inliers, ratio = verify_match_geometric(str(query_path), ref)
-        if inliers > best["inliers"] or (inliers == best["inliers"] and ratio > best["ratio"]):
-            best.update({
-                "passed": passed,
-                "inliers": inliers,
-                "ratio": ratio,
-            })
+    for future in as_completed(futures):
+        if future.cancelled():
+            continue
+        candidate_idx = futures[future]
+        if update_best(candidate_idx, future.result()):
+            for other, other_idx in futures.items():
+                if other_idx == candidate_idx:
+                    other.cancel()
 
-    best["strong"] = (
-        best["inliers"] >= GEOMETRY_STRONG_INLIERS and
-        best["ratio"] >= GEOMETRY_STRONG_RATIO
-    )
+    record_timings()
+    return results
 
-    return best
+def verify_candidate_geometry(query_image, candidate, references, limit=GEOMETRY_TOP_REFS, matchers=None):
+    return verify_candidates_geometry(
+        query_image, [candidate], references, limit=limit, matchers=matchers
+    )[0]
 
 def haversine_distance_m(lat1, lon1, lat2, lon2):
     earth_radius_m = 6371000.0
@@ -713,59 +1687,371 @@ def apply_gps_prior_to_ranked(ranked_waypoints, query_lat, query_lon, query_accu
     adjusted.sort(key=lambda x: x["final_score"], reverse=True)
     return adjusted
 
-def prepare_index_content(waypoint_index):
+def build_gps_prefilter(waypoint_index, embedding_index, min_waypoints=GPS_PREFILTER_MIN_WAYPOINTS):
+    """
+    Griglia spaziale sulle posizioni dei waypoint (gps_lat / gps_lon degli
+    item) e colonne dell'indice raggruppate per waypoint. None se il tour
+    ha meno di min_waypoints waypoint geolocalizzati.
+    """
+    waypoint_names = embedding_index["waypoint_names"]
+    waypoint_ids = {name: i for i, name in enumerate(waypoint_names)}
+    positions = {}
+    radius_m = {}
+
+    for item in waypoint_index:
+        lat = item.get("gps_lat")
+        lon = item.get("gps_lon")
+        if lat is None or lon is None:
+            continue
+        try:
+            lat, lon = float(lat), float(lon)
+            item_radius_m = float(item.get("gps_radius_m", GPS_DEFAULT_RADIUS_M))
+        except (TypeError, ValueError):
+            continue
+        waypoint_id = waypoint_ids[item["waypoint_name"]]
+        positions.setdefault(waypoint_id, (lat, lon))
+        radius_m[waypoint_id] = max(radius_m.get(waypoint_id, 0.0), item_radius_m)
+
+    if min_waypoints is None or len(positions) < max(int(min_waypoints), 1):
+        return None
+
+    located_ids = sorted(positions)
+    grid = GeoGridIndex(
+        located_ids,
+        [positions[i][0] for i in located_ids],
+        [positions[i][1] for i in located_ids],
+        cell_m=GPS_PREFILTER_CELL_M,
+    )
+
+    return {
+        "grid": grid,
+        "max_radius_m": max(radius_m.values()),
+        # I waypoint senza GPS non si possono escludere: sempre valutati
+        "unlocated_waypoint_ids": np.asarray(
+            [i for i in range(len(waypoint_names)) if i not in positions], dtype=np.int32
+        ),
+        # Stessi array dell'indice, non copie
+        "waypoint_columns": embedding_index["waypoint_columns"],
+        "waypoint_offsets": embedding_index["waypoint_offsets"],
+    }
+
+def gps_prefilter_columns(gps_prefilter, query_lat, query_lon, query_accuracy_m):
+    """
+    Colonne (crescenti) dei waypoint entro il raggio prudente dalla query,
+    oppure None quando il prefiltro non si applica: precisione assente o
+    scarsa, o meno di GPS_PREFILTER_MIN_CANDIDATES waypoint nel raggio.
+    """
+    if query_accuracy_m is None or float(query_accuracy_m) > GPS_PREFILTER_MAX_ACCURACY_M:
+        return None
+
+    effective_radius_m = max(gps_prefilter["max_radius_m"], float(query_accuracy_m), GPS_DEFAULT_RADIUS_M)
+    far_distance_m = max(effective_radius_m * GPS_FAR_MULTIPLIER, GPS_MIN_FAR_DISTANCE_M)
+    radius_m = max(far_distance_m * GPS_PREFILTER_FAR_FACTOR, GPS_PREFILTER_MIN_RADIUS_M)
+
+    nearby_ids = gps_prefilter["grid"].query(float(query_lat), float(query_lon), radius_m)
+    waypoint_ids = np.union1d(nearby_ids, gps_prefilter["unlocated_waypoint_ids"])
+    if len(waypoint_ids) < GPS_PREFILTER_MIN_CANDIDATES:
+        return None
+
+    return columns_of_waypoints(gps_prefilter, waypoint_ids)
+
+def prefiltered_ranking_is_ambiguous(ranked_waypoints, calibration):
+    """Ranking sui soli waypoint vicini troppo debole o incerto: serve la scansione completa."""
+    if not ranked_waypoints:
+        return True
+    top1 = ranked_waypoints[0]["final_score"]
+    if top1 < calibration["min_similarity_threshold"]:
+        return True
+    return len(ranked_waypoints) > 1 and top1 - ranked_waypoints[1]["final_score"] < AMBIGUOUS_MARGIN
+
+def prepare_index_content(
+    waypoint_index,
+    embeddings=None,
+    embedding_scales=None,
+    calibration_stats=None,
+    matcher_backend=GEOMETRY_MATCHER_BACKEND,
+    ann_min_items=ANN_MIN_ITEMS,
+    hierarchical_min_waypoints=HIERARCHICAL_MIN_WAYPOINTS,
+):
+    embedding_index = build_embedding_index(
+        waypoint_index,
+        embeddings=embeddings,
+        embedding_scales=embedding_scales,
+    )
+    # Gli embedding JSON (liste di float Python) sono ormai nella matrice:
+    # il contesto tiene copie superficiali degli item senza, cosi' la lista
+    # del chiamante resta intatta (riusabile per un altro contesto o un retry)
+    waypoint_index = [
+        {key: value for key, value in item.items() if key != "embedding"}
+        for item in waypoint_index
+    ]
+    reference_geometry_blocks = decode_reference_geometry(waypoint_index)
+
+    gps_prefilter = build_gps_prefilter(waypoint_index, embedding_index)
+    if gps_prefilter is not None:
+        print(f"GPS prefilter built over {len(gps_prefilter['grid'])} located waypoints")
+
+    ann_index = None
+    n_embeddings = len(embedding_index["embeddings"])
+    if ann_min_items is not None and n_embeddings >= max(int(ann_min_items), 1):
+        ann_index = IVFFlatIndex(embedding_index["embeddings"])
+        print(f"ANN index built: {ann_index.n_lists} lists over {n_embeddings} embeddings")
+
+    n_waypoints = len(embedding_index["waypoint_names"])
+    hierarchical = (
+        hierarchical_min_waypoints is not None and
+        n_waypoints >= max(int(hierarchical_min_waypoints), 1)
+    )
+    if hierarchical:
+        print(f"Hierarchical ranking enabled over {n_waypoints} waypoints")
+
     return {
         "waypoint_index": waypoint_index,
-        "centroids": compute_waypoint_centroids(waypoint_index),
-        "calibrations": calibrate_index_from_originals(waypoint_index),
+        "embedding_index": embedding_index,
+        "centroids": compute_waypoint_centroids(embedding_index),
+        "calibrations": calibrate_index_from_originals(embedding_index, calibration_stats),
         "view_weights": get_query_view_weights(),
+        "reference_geometry": reference_geometry_blocks,
+        "geometry_references": build_geometry_reference_lookup(waypoint_index),
+        "geometry_matchers": build_geometry_matchers(waypoint_index, backend=matcher_backend),
+        "ann_index": ann_index,
+        "gps_prefilter": gps_prefilter,
+        "hierarchical": hierarchical,
     }
 
+def _root_array(array):
+    while isinstance(array.base, np.ndarray):
+        array = array.base
+    return array
+
+def _python_nbytes(value):
+    size = sys.getsizeof(value)
+    if isinstance(value, (list, tuple)):
+        size += sum(_python_nbytes(v) for v in value)
+    return size
+
+def context_nbytes(context):
+    """
+    Stima dei byte residenti di un contesto preparato: buffer NumPy distinti
+    (una vista conta col suo array di base, memmap inclusi), copie dei
+    descrittori nei matcher prebuilt e metadati Python degli item.
+    """
+    buffers = {}
+
+    def add_arrays(value):
+        if isinstance(value, np.ndarray):
+            root = _root_array(value)
+            buffers[id(root)] = root.nbytes
+        elif isinstance(value, dict):
+            for v in value.values():
+                add_arrays(v)
+
+    add_arrays(context["embedding_index"])
+    add_arrays(context["centroids"])
+    add_arrays(context["reference_geometry"])
+    if context.get("ann_index") is not None:
+        add_arrays(vars(context["ann_index"]))
+    if context.get("gps_prefilter") is not None:
+        add_arrays(context["gps_prefilter"])
+        add_arrays(vars(context["gps_prefilter"]["grid"]))
+
+    metadata_bytes = 0
+    for item in context["waypoint_index"]:
+        metadata_bytes += sys.getsizeof(item)
+        for value in item.values():
+            if isinstance(value, np.ndarray):
+                add_arrays(value)
+            else:
+                metadata_bytes += _python_nbytes(value)
+
+    matchers = context.get("geometry_matchers") or {}
+    matcher_bytes = sum(m.nbytes for m in matchers.get("by_reference", {}).values())
+    matcher_bytes += sum(m["matcher"].nbytes for m in matchers.get("by_waypoint", {}).values())
+
+    return sum(buffers.values()) + metadata_bytes + matcher_bytes
+
+def load_index_content(
+    index_path,
+    matcher_backend=GEOMETRY_MATCHER_BACKEND,
+    ann_min_items=ANN_MIN_ITEMS,
+    hierarchical_min_waypoints=HIERARCHICAL_MIN_WAYPOINTS,
+):
+    """Carica training_data.json oppure il formato binario (.bin) in memmap."""
+    if Path(index_path).suffix == BINARY_INDEX_SUFFIX:
+        items, arrays, metadata = load_binary_index(index_path)
+        return prepare_index_content(
+            items,
+            embeddings=arrays["embeddings"],
+            embedding_scales=arrays.get("embedding_scales"),
+            calibration_stats=metadata.get("calibration"),
+            matcher_backend=matcher_backend,
+            ann_min_items=ann_min_items,
+            hierarchical_min_waypoints=hierarchical_min_waypoints,
+        )
+
+    with open(index_path, "r", encoding="utf-8") as f:
+        waypoint_index = json.load(f)
+    return prepare_index_content(
+        waypoint_index,
+        matcher_backend=matcher_backend,
+        ann_min_items=ann_min_items,
+        hierarchical_min_waypoints=hierarchical_min_waypoints,
+    )
+
+def embed_query_views(query_image, embedder, view_names, timings=None):
+    """Embedding delle sole viste richieste, in un unico invoke batched."""
+    if tuple(view_names) == ("center",):
+        images = [query_image.embedding_pil]
+    else:
+        views = query_image.views()
+        images = [views[name] for name in view_names]
+    processed = [preprocess_image_dart_compatible(image) for image in images]
+    return dict(zip(view_names, embedder.embed_batch(processed, timings=timings)))
+
+def rank_query(query_embeddings, context, gps_lat=None, gps_lon=None, gps_accuracy_m=None, timings=None):
+    """Ranking visivo (con prefiltro GPS e fallback) seguito dal prior GPS."""
+    waypoint_index = context["waypoint_index"]
+    embedding_index = context["embedding_index"]
+    calibration = context["calibrations"]
+    rank_kwargs = dict(
+        top_k_per_waypoint=TOP_ITEMS_FOR_WAYPOINT_SCORE,
+        centroids=context["centroids"],
+        view_weights=context["view_weights"],
+    )
+
+    with stage_timer(timings, "ranking"):
+        ranked_waypoints = None
+
+        # GPS preciso: prima solo i waypoint vicini, scansione completa se
+        # il risultato ristretto e' vuoto, debole o ambiguo
+        gps_prefilter = context.get("gps_prefilter")
+        if gps_prefilter is not None and gps_lat is not None and gps_lon is not None:
+            columns = gps_prefilter_columns(gps_prefilter, gps_lat, gps_lon, gps_accuracy_m)
+            if columns is not None:
+                ranked_waypoints = rank_waypoints_by_similarity(
+                    query_embeddings, embedding_index, waypoint_index, columns=columns, **rank_kwargs
+                )
+                print(f"GPS prefilter -> {len(columns)}/{len(embedding_index['embeddings'])} embeddings")
+                if prefiltered_ranking_is_ambiguous(ranked_waypoints, calibration):
+                    print("GPS prefilter ambiguous, falling back to full scan")
+                    ranked_waypoints = None
+
+        if ranked_waypoints is None:
+            ranked_waypoints = rank_waypoints_by_similarity(
+                query_embeddings,
+                embedding_index,
+                waypoint_index,
+                ann_index=context.get("ann_index"),
+                hierarchical=context.get("hierarchical", False),
+                **rank_kwargs,
+            )
+
+    if gps_lat is not None and gps_lon is not None:
+        with stage_timer(timings, "gps_prior"):
+            ranked_waypoints = apply_gps_prior_to_ranked(
+                ranked_waypoints,
+                query_lat = gps_lat,
+                query_lon = gps_lon,
+                query_accuracy_m=gps_accuracy_m,
+            )
+    return ranked_waypoints
+
+def decision_thresholds(calibration, quality):
+    """Soglie (minima, soft, direct) della decisione, alzate per query di bassa qualita'."""
+    quality_bump = float(quality["threshold_bump"])
+
+    min_similarity_threshold = calibration["min_similarity_threshold"] + min(quality_bump, 0.04)
+    soft_accept_threshold = calibration["soft_accept_threshold"] + quality_bump
+    direct_accept_threshold = max(
+        calibration["direct_accept_threshold"] + quality_bump,
+        soft_accept_threshold + 0.045
+    )
+    return min_similarity_threshold, soft_accept_threshold, direct_accept_threshold
+
+def is_certain_direct_accept(ranked_waypoints, soft_accept_threshold, direct_accept_threshold):
+    """
+    Direct accept che la verifica geometrica non potrebbe piu' ribaltare:
+    con margine >= 0.10 e top2 sotto soft - 0.04 il secondo candidato non
+    viene verificato, quindi il veto "top2 strong" non puo' scattare.
+    La garanzia vale solo rispetto alla geometria e a parita' di viste:
+    sulle viste di uno stadio intermedio della cascata (es. solo center)
+    vote ratio e consensus non sono quelli del ranking con tutte le viste.
+    """
+    if not ranked_waypoints:
+        return False
+    top1 = ranked_waypoints[0]
+    top2_final = ranked_waypoints[1]["final_score"] if len(ranked_waypoints) > 1 else 0.0
+    final_margin = top1["final_score"] - top2_final
+
+    return (
+        top1["final_score"] >= direct_accept_threshold and
+        final_margin >= max(DIRECT_ACCEPT_MARGIN, 0.10) and
+        top1["view_vote_ratio"] >= DIRECT_ACCEPT_MIN_VOTE_RATIO and
+        top1["original_consensus_score"] >= ORIGINAL_MIN_FOR_DIRECT and
+        top2_final < soft_accept_threshold - 0.04
+    )
+
 def run_inference(
-    image_path,
+    query_image,
     context,
-    interpreter,
+    embedder,
     skip_geometry = False,
     gps_lat = None,
     gps_lon = None,
     gps_accuracy_m = GPS_DEFAULT_ACCURACY_M,
+    timings = None,
+    report = None,
 ):
-    waypoint_index = context["waypoint_index"]
-    centroids = context["centroids"]
+    """
+    Riconosce il waypoint della query sul contesto del tour. Con `timings`
+    (dict) vi accumula i secondi per fase: embedding (con
+    embedding_queue_wait), quality, ranking, gps_prior, geometry e
+    geometry_candidate (lista, uno per candidato verificato).
+    Con `report` (dict) vi scrive lo stadio della cascata che ha deciso
+    ("decided_by": center, crops, photometric o geometry) e la condizione
+    ("condition": direct, soft, gps_promoted, geometry_rescue o rejected).
+    """
     calibration = context["calibrations"]
-    view_weights = context["view_weights"]
-    
-    if MULTI_VIEW_ENABLED:
-        query_embeddings = extract_query_embeddings_multi_view_tflite(
-            image_path,
-            interpreter,
-        )
-    else:
-        image = Image.open(image_path).convert("RGB")
-        processed = preprocess_image_dart_compatible(image)
-        query_embeddings = {"center": run_tflite_embedder(interpreter, processed)}
-        
-    quality = assess_image_quality(image_path)
-    
-    ranked_waypoints = rank_waypoints_by_similarity(
-        query_embeddings,
-        waypoint_index,
-        top_k_per_waypoint=TOP_ITEMS_FOR_WAYPOINT_SCORE,
-        centroids=centroids,
-        view_weights=view_weights,
+    geometry_matchers = context.get("geometry_matchers")
+    geometry_references = context["geometry_references"]
+
+    def decided(stage, condition, result):
+        if report is not None:
+            report["decided_by"] = stage
+            report["condition"] = condition
+        return result
+
+    with stage_timer(timings, "quality"):
+        quality = assess_image_quality(query_image)
+    min_similarity_threshold, soft_accept_threshold, direct_accept_threshold = (
+        decision_thresholds(calibration, quality)
     )
-    
-    if gps_lat is not None and gps_lon is not None:
-        ranked_waypoints = apply_gps_prior_to_ranked(
-            ranked_waypoints,
-            query_lat = gps_lat,
-            query_lon = gps_lon,
-            query_accuracy_m=gps_accuracy_m,
+
+    # Cascata: uno stadio di viste alla volta, stop al primo direct accept
+    # certo; senza multi-view c'e' solo lo stadio center.
+    cascade = QUERY_VIEW_CASCADE if MULTI_VIEW_ENABLED else QUERY_VIEW_CASCADE[:1]
+    query_embeddings = {}
+    for stage_name, view_names in cascade:
+        with stage_timer(timings, "embedding"):
+            query_embeddings.update(embed_query_views(query_image, embedder, view_names, timings=timings))
+
+        ranked_waypoints = rank_query(
+            query_embeddings, context, gps_lat, gps_lon, gps_accuracy_m, timings=timings
         )
-        
+        if is_certain_direct_accept(ranked_waypoints, soft_accept_threshold, direct_accept_threshold):
+            top1 = ranked_waypoints[0]
+            print(
+                f"Cascade {stage_name} -> direct accept {top1['waypoint_name']} | "
+                f"final={top1['final_score']:.4f} | views={len(query_embeddings)}"
+            )
+            print(f"Recognized waypoint: {top1['waypoint_name']}")
+            return decided(stage_name, "direct", top1["waypoint_name"])
+
+    final_stage = stage_name if skip_geometry else "geometry"
+
     if not ranked_waypoints:
         print("No matching waypoint found.")
-        return None
+        return decided(final_stage, "rejected", None)
     
     print("\nTop waypoint candidates:")
     if gps_lat is not None and gps_lon is not None:
@@ -805,23 +2091,27 @@ def run_inference(
     
     quality_bump = float(quality["threshold_bump"])
     
-    min_similarity_threshold = calibration["min_similarity_threshold"] + min(quality_bump, 0.04)
-    soft_accept_threshold = calibration["soft_accept_threshold"] + quality_bump
-    direct_accept_threshold = max(
-        calibration["direct_accept_threshold"] + quality_bump,
-        soft_accept_threshold + 0.045
-    )
-    
     top1_geometry = {"passed": False, "strong": False, "inliers": 0, "ratio": 0.0, "refs_checked": 0}
     top2_geometry = {"passed": False, "strong": False, "inliers": 0, "ratio": 0.0, "refs_checked": 0}
 
     if not skip_geometry:
-        top1_geometry = verify_candidate_geometry(image_path, top1, waypoint_index)
-
+        geometry_candidates = [top1]
         if len(ranked_waypoints) > 1 and (
             final_margin < 0.10 or top2_final >= soft_accept_threshold - 0.04
         ):
-            top2_geometry = verify_candidate_geometry(image_path, ranked_waypoints[1], waypoint_index)
+            geometry_candidates.append(ranked_waypoints[1])
+
+        with stage_timer(timings, "geometry"):
+            geometry_results = verify_candidates_geometry(
+                query_image,
+                geometry_candidates,
+                geometry_references,
+                matchers=geometry_matchers,
+                timings=timings,
+            )
+        top1_geometry = geometry_results[0]
+        if len(geometry_results) > 1:
+            top2_geometry = geometry_results[1]
     
     print(
         f"Calibration -> neg_p90={calibration['negative_p90']:.4f} | "
@@ -949,25 +2239,55 @@ def run_inference(
 
     if top1["final_score"] < min_similarity_threshold and not geometry_rescue_condition:
         print("No matching waypoint found")
-        return None
+        return decided(final_stage, "rejected", None)
 
-    if direct_condition or gps_promoted_condition or soft_condition or geometry_rescue_condition:
+    accepted_by = next(
+        (
+            name for name, condition in (
+                ("direct", direct_condition),
+                ("gps_promoted", gps_promoted_condition),
+                ("soft", soft_condition),
+                ("geometry_rescue", geometry_rescue_condition),
+            )
+            if condition
+        ),
+        None,
+    )
+    if accepted_by is not None:
         print(f"Recognized waypoint: {top1['waypoint_name']}")
-        return top1["waypoint_name"]
+        return decided(final_stage, accepted_by, top1["waypoint_name"])
 
     print("No matching waypoint found")
-    return None
+    return decided(final_stage, "rejected", None)
 
 def main():
     parser = argparse.ArgumentParser(description="Classifica una query usando indice TFLite/JSON.")
     parser.add_argument("--image-path", required=True, help="Percorso immagine di query")
-    parser.add_argument("--index-json", required=True, help="Percorso training_data.json")
+    parser.add_argument("--index-json", required=True, help="Percorso training_data.json (o training_data.bin)")
     parser.add_argument("--tflite-model", required=True, help="Percorso modello TFLite")
     parser.add_argument(
         "--skip-geometry",
         action="store_true",
         help="Compatibilità: pipeline embedding-only.",
     )
+    parser.add_argument(
+        "--matcher-backend",
+        choices=GEOMETRY_MATCHER_BACKENDS,
+        default=GEOMETRY_MATCHER_BACKEND,
+        help="Matcher dei descrittori ORB per la verifica geometrica.",
+    )
+    parser.add_argument(
+        "--ann-min-items",
+        type=int,
+        default=ANN_MIN_ITEMS,
+        help="Numero di embedding oltre il quale il ranking usa l'indice IVF approssimato.",
+    )
+    parser.add_argument(
+        "--hierarchical-min-waypoints",
+        type=int,
+        default=HIERARCHICAL_MIN_WAYPOINTS,
+        help="Numero di waypoint da cui il ranking passa prima per i centroidi.",
+    )
     parser.add_argument("--gps-lat", type=float, default=None, help="Latitudine GPS della query")
     parser.add_argument("--gps-lon", type=float, default=None, help="Longitudine GPS della query")
     parser.add_argument("--gps-accuracy-m", type=float, default=GPS_DEFAULT_ACCURACY_M, help="Precisione GPS della query in metri")
@@ -983,17 +2303,19 @@ def main():
         print("No matching waypoint found.")
         return None
 
-    with open(args.index_json, "r", encoding="utf-8") as f:
-        waypoint_index = json.load(f)
-
-    interpreter = load_tflite_interpreter(Path(args.tflite_model))
-    context = prepare_index_content(waypoint_index)
+    embedder = TFLiteEmbedder(load_tflite_interpreter(Path(args.tflite_model)))
+    context = load_index_content(
+        args.index_json,
+        matcher_backend=args.matcher_backend,
+        ann_min_items=args.ann_min_items,
+        hierarchical_min_waypoints=args.hierarchical_min_waypoints,
+    )
 
     print(f"\n📸 Query: {args.image_path}")
     result = run_inference(
-        image_path=args.image_path,
+        query_image=QueryImage.from_path(args.image_path),
         context=context,
-        interpreter=interpreter,
+        embedder=embedder,
         skip_geometry=args.skip_geometry,
         gps_lat=args.gps_lat,
         gps_lon=args.gps_lon,
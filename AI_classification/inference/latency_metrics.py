@@ -0,0 +1,112 @@
+import threading
+
+# Limiti superiori (secondi) dei bucket degli istogrammi di latenza
+LATENCY_BUCKETS_S = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0,
+)
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape_label(value)}"' for name, value in labels) + "}"
+
+
+class LatencyMetrics:
+    """
+    Istogrammi di latenza per fase della pipeline (etichetta stage), con
+    bucket cumulativi, somma e conteggio come gli istogrammi Prometheus.
+    render() produce il formato testuale di esposizione di /metrics.
+    """
+
+    def __init__(self, name="xr_inference_stage_seconds", buckets=LATENCY_BUCKETS_S):
+        self.name = name
+        self.buckets = tuple(sorted(float(b) for b in buckets))
+        self._lock = threading.Lock()
+        self._histograms = {}
+
+    def observe(self, stage, seconds):
+        seconds = float(seconds)
+        with self._lock:
+            histogram = self._histograms.get(stage)
+            if histogram is None:
+                histogram = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+                self._histograms[stage] = histogram
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram["counts"][i] += 1
+                    break
+            histogram["sum"] += seconds
+            histogram["count"] += 1
+
+    def observe_timings(self, timings):
+        """Registra le fasi di una richiesta (dict fase -> secondi, o lista di secondi)."""
+        for stage, value in timings.items():
+            for seconds in value if isinstance(value, (list, tuple)) else [value]:
+                self.observe(stage, seconds)
+
+    def render(self):
+        with self._lock:
+            snapshot = {
+                stage: (list(h["counts"]), h["sum"], h["count"])
+                for stage, h in self._histograms.items()
+            }
+
+        lines = [
+            f"# HELP {self.name} Latenza per fase della pipeline di inferenza.",
+            f"# TYPE {self.name} histogram",
+        ]
+        for stage in sorted(snapshot):
+            counts, total, count = snapshot[stage]
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels([("stage", stage), ("le", _format_value(bound))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels([("stage", stage), ("le", "+Inf")])
+            lines.append(f"{self.name}_bucket{labels} {count}")
+            labels = _format_labels([("stage", stage)])
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return "\n".join(lines) + "\n"
+
+
+class LabeledCounter:
+    """Contatori per combinazione di etichette, thread-safe."""
+
+    def __init__(self, label_names):
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+        self._counts = {}
+
+    def inc(self, *label_values):
+        with self._lock:
+            self._counts[label_values] = self._counts.get(label_values, 0) + 1
+
+    def samples(self):
+        """Lista di (labels, valore) per render_metric_family."""
+        with self._lock:
+            counts = dict(self._counts)
+        return [
+            (list(zip(self.label_names, values)), count)
+            for values, count in sorted(counts.items())
+        ]
+
+
+def render_metric_family(name, metric_type, help_text, samples):
+    """Una famiglia Prometheus (counter o gauge) da una lista di (labels, valore)."""
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}"]
+    for labels, value in samples:
+        lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
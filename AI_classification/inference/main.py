@@ -13,18 +13,32 @@ from pydantic import BaseModel
 from fastapi.middleware.cors import CORSMiddleware
 import boto3
 from urllib.parse import urlparse
-import shutil
 import threading
 import base64
-from fastapi.responses import JSONResponse
+import math
+from fastapi.responses import JSONResponse, PlainTextResponse
 import dotenv
 import json
+import time
 import tempfile
+from starlette.concurrency import run_in_threadpool
 from inference_script import (
-    load_tflite_interpreter,
+    MicroBatchingEmbedder,
+    QueryImage,
+    QueryImageStream,
+    TFLiteEmbedderPool,
+    context_nbytes,
     prepare_index_content,
     run_inference,
 )
+from common.tour_index import (
+    INDEX_BUILD_ID_METADATA_KEY,
+    binary_index_key,
+    load_binary_index,
+)
+from tour_context_cache import SingleFlight, TourContextCache
+from result_cache import QueryResultCache, gps_cell
+from latency_metrics import LabeledCounter, LatencyMetrics, render_metric_family
 
 dotenv.load_dotenv()
 
@@ -43,6 +57,9 @@ class Response(BaseModel):
     view_name: str | None = None
     poi_id: str | None = None
     message: str | None = None
+    cache_hit: bool | None = None
+    decided_by: str | None = None
+    timings_ms: dict | None = None
 
 
 class InferenceRequest(BaseModel):
@@ -56,6 +73,7 @@ class InferenceRequest(BaseModel):
     gps_lat: float | None = None
     gps_lon: float | None = None
     gps_accuracy_m: float | None = None
+    debug_timings: bool | None = False
 
 
 app = FastAPI()
@@ -80,11 +98,90 @@ s3 = boto3.client(
 
 TFLITE_MODEL_PATH = str(CURRENT_DIR / "./EfficientNetLite0.tflite")
 
-INTERPRETER = load_tflite_interpreter(TFLITE_MODEL_PATH)
-INTERPRETER_LOCK = threading.Lock()
+# Un interprete per worker: solo l'embedding e' serializzato sul singolo
+# interprete, il resto della pipeline gira in parallelo nel threadpool.
+INTERPRETER_POOL_SIZE = int(os.getenv("INTERPRETER_POOL_SIZE", "2"))
+INTERPRETER_NUM_THREADS = (
+    int(os.getenv("INTERPRETER_NUM_THREADS"))
+    if os.getenv("INTERPRETER_NUM_THREADS")
+    else None
+)
+
+# Micro-batching degli embedding: le query concorrenti attendono al massimo
+# EMBED_BATCH_WAIT_MS e vengono embeddate insieme (fino a EMBED_BATCH_MAX
+# immagini). EMBED_BATCH_MAX=1 usa il pool direttamente.
+EMBED_BATCH_MAX = int(os.getenv("EMBED_BATCH_MAX", "16"))
+EMBED_BATCH_WAIT_MS = float(os.getenv("EMBED_BATCH_WAIT_MS", "5"))
 
-TOUR_INDEX_CACHE = {}
-TOUR_INDEX_CACHE_LOCK = threading.Lock()
+EMBEDDER_POOL = TFLiteEmbedderPool(
+    TFLITE_MODEL_PATH,
+    size=INTERPRETER_POOL_SIZE,
+    num_threads=INTERPRETER_NUM_THREADS,
+)
+EMBEDDER = (
+    MicroBatchingEmbedder(EMBEDDER_POOL, max_batch=EMBED_BATCH_MAX, max_wait_ms=EMBED_BATCH_WAIT_MS)
+    if EMBED_BATCH_MAX > 1
+    else EMBEDDER_POOL
+)
+
+# Contesti dei tour in LRU: budget in byte stimati (embedding, descrittori,
+# centroidi, matcher, metadati) e TTL di inattivita' (0 = disattivato).
+TOUR_INDEX_CACHE_MAX_BYTES = int(os.getenv("TOUR_INDEX_CACHE_MAX_BYTES", str(2 * 1024 ** 3)))
+TOUR_INDEX_CACHE_IDLE_TTL_S = float(os.getenv("TOUR_INDEX_CACHE_IDLE_TTL_S", "3600"))
+
+TOUR_INDEX_CACHE = TourContextCache(
+    max_bytes=TOUR_INDEX_CACHE_MAX_BYTES,
+    size_fn=context_nbytes,
+    idle_ttl_s=TOUR_INDEX_CACHE_IDLE_TTL_S,
+)
+
+# Finestra di freschezza: per INDEX_REVALIDATE_AFTER_S secondi dopo l'ultima
+# verifica un tour in cache si serve senza HEAD su S3; poi l'ETag viene
+# ricontrollato in background. /cache/invalidate forza la verifica subito.
+INDEX_REVALIDATE_AFTER_S = float(os.getenv("INDEX_REVALIDATE_AFTER_S", "30"))
+REVALIDATING = set()
+REVALIDATING_LOCK = threading.Lock()
+
+# Un solo caricamento per tour alla volta (miss a freddo e rivalidazioni)
+INDEX_LOADS = SingleFlight()
+
+# Cache dei risultati per frame quasi identici (pHash entro
+# RESULT_CACHE_MAX_HAMMING bit, stessa versione dell'indice e stessa cella
+# GPS di RESULT_CACHE_GPS_CELL_DEG gradi). RESULT_CACHE_TTL_S=0 la disattiva.
+RESULT_CACHE_TTL_S = float(os.getenv("RESULT_CACHE_TTL_S", "0"))
+RESULT_CACHE_MAX_HAMMING = int(os.getenv("RESULT_CACHE_MAX_HAMMING", "4"))
+RESULT_CACHE_GPS_CELL_DEG = float(os.getenv("RESULT_CACHE_GPS_CELL_DEG", "0.001"))
+
+RESULT_CACHE = (
+    QueryResultCache(ttl_s=RESULT_CACHE_TTL_S, max_hamming=RESULT_CACHE_MAX_HAMMING)
+    if RESULT_CACHE_TTL_S > 0
+    else None
+)
+
+# Indici binari scaricati e aperti in memmap: i worker che leggono lo stesso
+# file (stessa chiave + ETag) condividono le pagine in memoria.
+INDEX_FILE_CACHE_DIR = Path(os.getenv("INDEX_FILE_CACHE_DIR", "/data/index_cache"))
+# Versioni per tour tenute su disco: un altro worker puo' aver appena letto
+# l'ETag precedente e stare per aprire il relativo file.
+INDEX_FILE_CACHE_KEEP_VERSIONS = max(1, int(os.getenv("INDEX_FILE_CACHE_KEEP_VERSIONS", "2")))
+
+# bf | flann_lsh | bf_waypoint (vedi build_geometry_matchers)
+GEOMETRY_MATCHER_BACKEND = os.getenv("GEOMETRY_MATCHER_BACKEND", "bf")
+
+# Sopra questa soglia di embedding il ranking passa all'indice IVF approssimato
+ANN_MIN_ITEMS = int(os.getenv("ANN_MIN_ITEMS", "20000"))
+
+# Da questo numero di waypoint il ranking passa per i centroidi (gerarchico)
+HIERARCHICAL_MIN_WAYPOINTS = int(os.getenv("HIERARCHICAL_MIN_WAYPOINTS", "100"))
+
+# Dimensione massima dell'immagine di query (byte compressi, prima del
+# base64): oltre il limite la richiesta e' rifiutata con 413.
+INFERENCE_MAX_IMAGE_BYTES = int(os.getenv("INFERENCE_MAX_IMAGE_BYTES", str(15 * 1024 ** 2)))
+
+# Istogrammi di latenza per fase, esposti su /metrics
+METRICS = LatencyMetrics()
+# Decisioni per stadio della cascata che ha deciso e condizione
+DECISIONS = LabeledCounter(("stage", "condition"))
 
 def download_minio_folder(prefix: str, local_dir: str, s3_client):
     """
@@ -143,19 +240,88 @@ def write_s3_file(file_path, remote_path):
     except Exception as e:
         print(f"Error writing file {file_path} to S3: {e}")
 
-def get_cached_tour_context(index_url: str):
-    if not index_url:
-        raise CustomHTTPException(
-            status_code=400,
-            detail="Missing index_url/model_url",
-            error_code=1002,
+class StaleBinaryIndexError(ValueError):
+    """Il .bin non appartiene al build del training_data.json pubblicato."""
+
+def download_binary_index(bucket: str, key: str, local_path: Path):
+    # Scaricato con un nome temporaneo e rinominato: chi apre local_path
+    # vede solo file completi
+    INDEX_FILE_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=INDEX_FILE_CACHE_DIR, suffix=".part")
+    os.close(fd)
+    try:
+        s3.download_file(bucket, key, tmp_path)
+        os.replace(tmp_path, local_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def prune_binary_index_versions(local_name: str, keep_path: Path):
+    """Tiene le INDEX_FILE_CACHE_KEEP_VERSIONS versioni piu' recenti del tour."""
+    versions = []
+    for path in INDEX_FILE_CACHE_DIR.glob(f"{local_name}.*"):
+        if path == keep_path or path.suffix == ".part":
+            continue
+        try:
+            versions.append((path.stat().st_mtime, path))
+        except FileNotFoundError:
+            continue
+
+    versions.sort(reverse=True)
+    # Le versioni rimosse restano leggibili da chi le ha gia' in memmap
+    for _mtime, stale_path in versions[INDEX_FILE_CACHE_KEEP_VERSIONS - 1:]:
+        stale_path.unlink(missing_ok=True)
+
+def load_binary_tour_context(bucket: str, key: str, etag: str, build_id: str):
+    local_name = key.replace("/", "_")
+    local_path = INDEX_FILE_CACHE_DIR / f"{local_name}.{etag}"
+
+    if not local_path.exists():
+        download_binary_index(bucket, key, local_path)
+    try:
+        items, arrays, metadata = load_binary_index(local_path)
+    except FileNotFoundError:
+        # Rimosso da un altro worker tra il controllo e l'apertura
+        download_binary_index(bucket, key, local_path)
+        items, arrays, metadata = load_binary_index(local_path)
+
+    if metadata.get("build_id") != build_id:
+        raise StaleBinaryIndexError(
+            f"Binary index {key} has build {metadata.get('build_id')}, expected {build_id}"
         )
 
-    bucket = os.getenv("AWS_STORAGE_BUCKET_NAME")
+    context = prepare_index_content(
+        items,
+        embeddings=arrays["embeddings"],
+        embedding_scales=arrays.get("embedding_scales"),
+        calibration_stats=metadata.get("calibration"),
+        matcher_backend=GEOMETRY_MATCHER_BACKEND,
+        ann_min_items=ANN_MIN_ITEMS,
+        hierarchical_min_waypoints=HIERARCHICAL_MIN_WAYPOINTS,
+    )
+
+    prune_binary_index_versions(local_name, local_path)
+    return context
+
+def load_json_tour_context(bucket: str, key: str):
+    response = s3.get_object(Bucket=bucket, Key=key)
+    raw = response["Body"].read()
+    waypoint_index = json.loads(raw.decode("utf-8"))
+    return prepare_index_content(
+        waypoint_index,
+        matcher_backend=GEOMETRY_MATCHER_BACKEND,
+        ann_min_items=ANN_MIN_ITEMS,
+        hierarchical_min_waypoints=HIERARCHICAL_MIN_WAYPOINTS,
+    )
 
+def head_tour_index(bucket: str, index_url: str):
+    """
+    Chiave effettiva dell'indice, ETag e build_id del JSON. Preferisce
+    training_data.bin solo se e' stato generato dal training_data.json
+    pubblicato (stesso build_id nei metadati S3).
+    """
     try:
         head = s3.head_object(Bucket=bucket, Key=index_url)
-        etag = head.get("ETag", "").strip('"')
     except Exception as e:
         print(f"Error checking index metadata: {e}", flush=True)
         raise CustomHTTPException(
@@ -164,18 +330,28 @@ def get_cached_tour_context(index_url: str):
             error_code=1003,
         )
 
-    cache_key = f"{index_url}:{etag}"
-
-    with TOUR_INDEX_CACHE_LOCK:
-        cached = TOUR_INDEX_CACHE.get(cache_key)
-        if cached is not None:
-            return cached
-
+    build_id = head.get("Metadata", {}).get(INDEX_BUILD_ID_METADATA_KEY)
+    if build_id:
+        binary_key = binary_index_key(index_url)
+        try:
+            binary_head = s3.head_object(Bucket=bucket, Key=binary_key)
+        except Exception:
+            binary_head = None
+        if binary_head is not None:
+            if binary_head.get("Metadata", {}).get(INDEX_BUILD_ID_METADATA_KEY) == build_id:
+                return binary_key, binary_head.get("ETag", "").strip('"'), build_id
+            print(f"Stale binary index {binary_key}, using {index_url}", flush=True)
+
+    return index_url, head.get("ETag", "").strip('"'), build_id
+
+def load_tour_context(bucket: str, index_url: str, index_key: str, etag: str, build_id: str):
     try:
-        response = s3.get_object(Bucket=bucket, Key=index_url)
-        raw = response["Body"].read()
-        waypoint_index = json.loads(raw.decode("utf-8"))
-        context = prepare_index_content(waypoint_index)
+        if index_key != index_url:
+            try:
+                return load_binary_tour_context(bucket, index_key, etag, build_id)
+            except StaleBinaryIndexError as e:
+                print(f"{e}, using {index_url}", flush=True)
+        return load_json_tour_context(bucket, index_url)
     except Exception as e:
         print(f"Error loading/parsing index from S3: {e}", flush=True)
         raise CustomHTTPException(
@@ -184,17 +360,122 @@ def get_cached_tour_context(index_url: str):
             error_code=1007,
         )
 
-    with TOUR_INDEX_CACHE_LOCK:
-        keys_to_remove = [
-            key for key in TOUR_INDEX_CACHE
-            if key.startswith(f"{index_url}:")
-        ]
-        for key in keys_to_remove:
-            TOUR_INDEX_CACHE.pop(key, None)
+def fetch_tour_context(index_url: str):
+    """
+    Verifica l'ETag e, se la versione in cache e' diversa o assente, carica
+    e inserisce il nuovo contesto. Il vecchio continua a servire le
+    richieste fino al put, che lo sostituisce in modo atomico.
+    """
+    bucket = os.getenv("AWS_STORAGE_BUCKET_NAME")
+    index_key, etag, build_id = head_tour_index(bucket, index_url)
+
+    cached = TOUR_INDEX_CACHE.peek(index_url)
+    if cached is not None:
+        if cached["version"] == etag:
+            TOUR_INDEX_CACHE.mark_validated(index_url, etag)
+            return cached["context"]
+        print(f"New index version for {index_url}, reloading", flush=True)
+
+    load_started = time.perf_counter()
+    context = load_tour_context(bucket, index_url, index_key, etag, build_id)
+    METRICS.observe("index_load", time.perf_counter() - load_started)
+    context["index_version"] = etag
+    return TOUR_INDEX_CACHE.put(index_url, etag, context)
+
+def revalidate_tour_context(index_url: str):
+    try:
+        INDEX_LOADS.do(index_url, lambda: fetch_tour_context(index_url))
+    except Exception as e:
+        # Storage non raggiungibile: si continua a servire la versione in
+        # memoria e si riprova dopo un'altra finestra di freschezza.
+        print(f"Error revalidating index {index_url}: {e}", flush=True)
+        cached = TOUR_INDEX_CACHE.peek(index_url)
+        if cached is not None:
+            TOUR_INDEX_CACHE.mark_validated(index_url, cached["version"])
+    finally:
+        with REVALIDATING_LOCK:
+            REVALIDATING.discard(index_url)
+
+def schedule_revalidation(index_url: str):
+    with REVALIDATING_LOCK:
+        if index_url in REVALIDATING:
+            return
+        REVALIDATING.add(index_url)
+
+    threading.Thread(
+        target=revalidate_tour_context,
+        args=(index_url,),
+        name="index-revalidation",
+        daemon=True,
+    ).start()
+
+def require_index_url(model_url):
+    if not model_url:
+        raise CustomHTTPException(
+            status_code=400,
+            detail="Missing index_url/model_url",
+            error_code=1002,
+        )
+    return model_url
 
-        TOUR_INDEX_CACHE[cache_key] = context
+def get_cached_tour_context(index_url: str):
+    require_index_url(index_url)
 
-    return context
+    # Hit: nessun I/O di rete. Oltre la finestra di freschezza la versione
+    # viene verificata in background mentre si serve quella in memoria.
+    cached = TOUR_INDEX_CACHE.get(index_url)
+    if cached is not None:
+        if time.monotonic() - cached["validated_at"] >= INDEX_REVALIDATE_AFTER_S:
+            schedule_revalidation(index_url)
+        return cached["context"]
+
+    # Miss: le richieste concorrenti per lo stesso tour attendono un unico
+    # caricamento invece di scaricare e preparare l'indice ciascuna
+    return INDEX_LOADS.do(index_url, lambda: fetch_tour_context(index_url))
+
+def run_inference_cached(index_url, context, query_image, skip_geometry, gps_lat, gps_lon, gps_accuracy_m, timings=None, report=None):
+    """
+    run_inference passando dalla cache dei risultati, se attiva. Restituisce
+    (risultato, cache_hit); su un hit report["decided_by"] e' "result_cache".
+    """
+    def infer():
+        return run_inference(
+            query_image=query_image,
+            context=context,
+            embedder=EMBEDDER,
+            skip_geometry=skip_geometry,
+            gps_lat=gps_lat,
+            gps_lon=gps_lon,
+            gps_accuracy_m=gps_accuracy_m,
+            timings=timings,
+            report=report,
+        )
+
+    if RESULT_CACHE is None:
+        return infer(), False
+
+    group = (
+        index_url,
+        context.get("index_version"),
+        gps_cell(gps_lat, gps_lon, RESULT_CACHE_GPS_CELL_DEG),
+        bool(skip_geometry),
+    )
+    lookup_started = time.perf_counter()
+    phash = query_image.perceptual_hash()
+
+    found, result = RESULT_CACHE.get(group, phash)
+    if timings is not None:
+        timings["result_cache"] = time.perf_counter() - lookup_started
+    if found:
+        print(f"Result cache hit for {index_url}", flush=True)
+        if report is not None:
+            report["decided_by"] = "result_cache"
+            report["condition"] = "cached"
+        return result, True
+
+    result = infer()
+    RESULT_CACHE.put(group, phash, result)
+    return result, False
 
 def decode_base64_image(data: str) -> bytes:
     if data.startswith("data:"):
@@ -210,10 +491,8 @@ async def read_root():
 
 @app.post("/cache/clear")
 async def clear_cache():
-    with TOUR_INDEX_CACHE_LOCK:
-        cleared_count = len(TOUR_INDEX_CACHE)
-        TOUR_INDEX_CACHE.clear()
-        
+    cleared_count = TOUR_INDEX_CACHE.clear()
+
     print(f"Cleared {cleared_count} cached tour contexts")
     
     return JSONResponse(
@@ -225,28 +504,230 @@ async def clear_cache():
     )
 
 
+@app.post("/cache/invalidate")
+async def invalidate_cache(http_request: FastAPIRequest):
+    body = await http_request.json()
+    index_url = require_index_url(body.get("index_url") or body.get("model_url"))
+
+    # Il contesto attuale continua a servire finche' la nuova versione e' pronta
+    cached = TOUR_INDEX_CACHE.mark_stale(index_url)
+    if cached:
+        schedule_revalidation(index_url)
+
+    print(f"Invalidated tour context {index_url} (cached={cached})", flush=True)
+
+    return JSONResponse(
+        status_code=200,
+        content={"index_url": index_url, "cached": cached},
+    )
+
+
+@app.get("/cache/stats")
+async def cache_stats():
+    stats = TOUR_INDEX_CACHE.stats()
+    stats["results"] = RESULT_CACHE.stats() if RESULT_CACHE is not None else None
+    return JSONResponse(status_code=200, content=stats)
+
+
+@app.get("/metrics")
+async def metrics():
+    """Latenze per fase, eventi delle cache, decisioni e micro-batching in formato Prometheus."""
+    tour_stats = TOUR_INDEX_CACHE.stats()
+    cache_events = [
+        ([("cache", "tour_context"), ("event", event)], tour_stats[key])
+        for event, key in (("hit", "hits"), ("miss", "misses"), ("eviction", "evictions"), ("expiration", "expirations"))
+    ]
+    if RESULT_CACHE is not None:
+        result_stats = RESULT_CACHE.stats()
+        cache_events += [
+            ([("cache", "result"), ("event", "hit")], result_stats["hits"]),
+            ([("cache", "result"), ("event", "miss")], result_stats["misses"]),
+        ]
+
+    body = METRICS.render()
+    body += render_metric_family(
+        "xr_inference_cache_events_total", "counter",
+        "Eventi delle cache dei contesti dei tour e dei risultati.",
+        cache_events,
+    )
+    body += render_metric_family(
+        "xr_inference_tour_cache_bytes", "gauge",
+        "Byte stimati dei contesti dei tour in cache.",
+        [([], tour_stats["resident_bytes"])],
+    )
+    body += render_metric_family(
+        "xr_inference_decisions_total", "counter",
+        "Decisioni per stadio della cascata (center, crops, photometric, geometry, result_cache) e condizione.",
+        DECISIONS.samples(),
+    )
+    if isinstance(EMBEDDER, MicroBatchingEmbedder):
+        embed_stats = EMBEDDER.stats()
+        body += render_metric_family(
+            "xr_inference_embedding_batches_total", "counter",
+            "Batch di embedding eseguiti dal micro-batcher.",
+            [([], embed_stats["batches"])],
+        )
+        body += render_metric_family(
+            "xr_inference_embedding_images_total", "counter",
+            "Immagini embeddate dal micro-batcher.",
+            [([], embed_stats["images"])],
+        )
+
+    return PlainTextResponse(body, media_type="text/plain; version=0.0.4")
+
+
+def image_too_large():
+    return CustomHTTPException(
+        status_code=413,
+        detail=f"Image larger than {INFERENCE_MAX_IMAGE_BYTES} bytes",
+        error_code=1006,
+    )
+
+
+def unsupported_media_type(content_type):
+    return CustomHTTPException(
+        status_code=415,
+        detail=f"Unsupported content type: {content_type or 'missing'}",
+        error_code=1008,
+    )
+
+
+def parse_optional_float(value):
+    return float(value) if value not in (None, "", "null") else None
+
+
+# Limiti validi dei parametri GPS della query
+GPS_PARAM_RANGES = {
+    "gps_lat": (-90.0, 90.0),
+    "gps_lon": (-180.0, 180.0),
+    "gps_accuracy_m": (0.0, float("inf")),
+}
+
+
+def parse_gps_params(gps_lat, gps_lon, gps_accuracy_m):
+    """(lat, lon, accuracy) come float o None; 400 se un valore non e' valido."""
+    parsed = []
+    for name, value in (("gps_lat", gps_lat), ("gps_lon", gps_lon), ("gps_accuracy_m", gps_accuracy_m)):
+        low, high = GPS_PARAM_RANGES[name]
+        try:
+            number = parse_optional_float(value)
+        except (TypeError, ValueError):
+            number = float("nan")
+        if number is not None and not (math.isfinite(number) and low <= number <= high):
+            raise CustomHTTPException(
+                status_code=400,
+                detail=f"Invalid {name}: {value!r}",
+                error_code=1009,
+            )
+        parsed.append(number)
+    return tuple(parsed)
+
+
+def check_content_length(http_request: FastAPIRequest, limit: int):
+    """Rifiuta subito i body dichiarati piu' grandi di limit, prima di leggerli."""
+    content_length = http_request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > limit:
+        raise image_too_large()
+
+
+def timings_in_ms(timings):
+    return {
+        stage: [round(s * 1000.0, 3) for s in value] if isinstance(value, list) else round(value * 1000.0, 3)
+        for stage, value in timings.items()
+    }
+
+
+async def run_inference_request(
+    model_url, poi_name, poi_id, skip_geometry, gps_lat, gps_lon, gps_accuracy_m,
+    decode_query, started_at, debug_timings=False,
+):
+    """
+    Parte comune degli endpoint di inferenza: contesto del tour, decodifica
+    della query (decode_query, coroutine) e pipeline, fuori dall'event loop.
+    Le latenze per fase finiscono in METRICS e, con debug_timings, anche
+    nella risposta (timings_ms); decided_by riporta lo stadio che ha deciso.
+    """
+    print(f"Requested model: {model_url}", flush=True)
+    timings = {}
+    report = {}
+
+    # Lookup, download e preparazione dell'indice fuori dall'event loop
+    stage_started = time.perf_counter()
+    context = await run_in_threadpool(get_cached_tour_context, model_url)
+    timings["index_lookup"] = time.perf_counter() - stage_started
+
+    try:
+        stage_started = time.perf_counter()
+        query_image = await decode_query()
+        timings["decode"] = time.perf_counter() - stage_started
+    except ValueError as e:
+        print(f"Error decoding query image: {e}", flush=True)
+        raise CustomHTTPException(
+            status_code=400,
+            detail="Invalid image",
+            error_code=1005,
+        )
+
+    print("IMAGE READY", flush=True)
+
+    result, cache_hit = await run_in_threadpool(
+        run_inference_cached,
+        model_url,
+        context,
+        query_image,
+        skip_geometry,
+        gps_lat,
+        gps_lon,
+        gps_accuracy_m,
+        timings,
+        report,
+    )
+    if report:
+        DECISIONS.inc(report["decided_by"], report["condition"])
+
+    if result is None:
+        result = "No matching waypoint found."
+
+    timings["total"] = time.perf_counter() - started_at
+    METRICS.observe_timings(timings)
+
+    content = {
+        "model_url": model_url,
+        "report_url": f"/reports/{poi_name}",
+        "view_name": poi_name,
+        "poi_id": poi_id,
+        "message": result,
+        "cache_hit": cache_hit,
+        "decided_by": report.get("decided_by"),
+    }
+    if debug_timings:
+        content["timings_ms"] = timings_in_ms(timings)
+
+    return JSONResponse(status_code=200, content=content)
+
+
 @app.post("/inference")
 async def inference(http_request: FastAPIRequest):
+    started_at = time.perf_counter()
     try:
         content_type = http_request.headers.get("content-type", "")
 
         image_bytes = None
 
         if content_type.startswith("multipart/form-data"):
+            # Margine per i campi del form oltre all'immagine
+            check_content_length(http_request, INFERENCE_MAX_IMAGE_BYTES + 64 * 1024)
             form = await http_request.form()
 
             model_url = form.get("index_url") or form.get("model_url")
             poi_name = form.get("poi_name")
             poi_id = form.get("poi_id")
             skip_geometry = str(form.get("skip_geometry", "false")).lower() == "true"
+            debug_timings = str(form.get("debug_timings", "false")).lower() == "true"
 
-            gps_lat = form.get("gps_lat")
-            gps_lon = form.get("gps_lon")
-            gps_accuracy_m = form.get("gps_accuracy_m")
-
-            gps_lat = float(gps_lat) if gps_lat not in (None, "", "null") else None
-            gps_lon = float(gps_lon) if gps_lon not in (None, "", "null") else None
-            gps_accuracy_m = float(gps_accuracy_m) if gps_accuracy_m not in (None, "", "null") else None
+            gps_lat, gps_lon, gps_accuracy_m = parse_gps_params(
+                form.get("gps_lat"), form.get("gps_lon"), form.get("gps_accuracy_m")
+            )
 
             uploaded = form.get("image") or form.get("img")
             if uploaded is None:
@@ -259,16 +740,19 @@ async def inference(http_request: FastAPIRequest):
             image_bytes = await uploaded.read()
 
         else:
+            # base64: 4 caratteri ogni 3 byte
+            check_content_length(http_request, INFERENCE_MAX_IMAGE_BYTES * 4 // 3 + 64 * 1024)
             body = await http_request.json()
 
             model_url = body.get("index_url") or body.get("model_url")
             poi_name = body.get("poi_name")
             poi_id = body.get("poi_id")
             skip_geometry = bool(body.get("skip_geometry", False))
+            debug_timings = bool(body.get("debug_timings", False))
 
-            gps_lat = body.get("gps_lat")
-            gps_lon = body.get("gps_lon")
-            gps_accuracy_m = body.get("gps_accuracy_m")
+            gps_lat, gps_lon, gps_accuracy_m = parse_gps_params(
+                body.get("gps_lat"), body.get("gps_lon"), body.get("gps_accuracy_m")
+            )
 
             input_image_b64 = body.get("inference_image") or body.get("img")
 
@@ -281,45 +765,90 @@ async def inference(http_request: FastAPIRequest):
 
             image_bytes = decode_base64_image(input_image_b64)
 
-        print(f"Requested model: {model_url}", flush=True)
+        if len(image_bytes) > INFERENCE_MAX_IMAGE_BYTES:
+            raise image_too_large()
 
-        context = get_cached_tour_context(model_url)
+        async def decode_query():
+            return await run_in_threadpool(QueryImage.from_bytes, image_bytes)
 
-        data_dir = os.path.join("/data", str(poi_id or poi_name or "unknown"))
-        os.makedirs(data_dir, exist_ok=True)
+        return await run_inference_request(
+            model_url, poi_name, poi_id, skip_geometry,
+            gps_lat, gps_lon, gps_accuracy_m, decode_query,
+            started_at, debug_timings=debug_timings,
+        )
 
-        image_path = os.path.join(data_dir, "input_image.jpg")
+    except CustomHTTPException as e:
+        raise e
+    except Exception as e:
+        print(f"Unexpected error: {e}", flush=True)
+        raise CustomHTTPException(
+            status_code=500,
+            detail=str(e),
+            error_code=1001,
+        )
 
-        with open(image_path, "wb") as f:
-            f.write(image_bytes)
 
-        print("IMAGE READY", flush=True)
+def raw_request_param(http_request: FastAPIRequest, name, default=None):
+    """Parametro dalla query string (?gps_lat=...) o dall'header X-Gps-Lat."""
+    value = http_request.query_params.get(name)
+    if value is None:
+        value = http_request.headers.get("x-" + name.replace("_", "-"))
+    return value if value is not None else default
 
-        with INTERPRETER_LOCK:
-            result = run_inference(
-                image_path=image_path,
-                context=context,
-                interpreter=INTERPRETER,
-                skip_geometry=skip_geometry,
-                gps_lat=gps_lat,
-                gps_lon=gps_lon,
-                gps_accuracy_m=gps_accuracy_m,
-            )
 
-        shutil.rmtree(data_dir, ignore_errors=True)
+@app.post("/inference/raw")
+async def inference_raw(http_request: FastAPIRequest):
+    """
+    Inferenza con l'immagine come body binario (image/jpeg, image/png o
+    application/octet-stream) e i parametri in query string o header X-*.
+    I chunk del body finiscono in un solo buffer compresso, senza base64 ne'
+    copie intermedie, e la decodifica JPEG avviene gia' a scala ridotta; il
+    limite di dimensione vale prima di leggerlo.
+    """
+    started_at = time.perf_counter()
+    try:
+        content_type = http_request.headers.get("content-type", "")
+        if not (content_type.startswith("image/") or content_type.startswith("application/octet-stream")):
+            raise unsupported_media_type(content_type)
+
+        check_content_length(http_request, INFERENCE_MAX_IMAGE_BYTES)
+
+        model_url = raw_request_param(http_request, "index_url") or raw_request_param(http_request, "model_url")
+        poi_name = raw_request_param(http_request, "poi_name")
+        poi_id = raw_request_param(http_request, "poi_id")
+        skip_geometry = str(raw_request_param(http_request, "skip_geometry", "false")).lower() == "true"
+        debug_timings = str(raw_request_param(http_request, "debug_timings", "false")).lower() == "true"
+
+        # Input del client: valori malformati -> 400 prima di leggere il body
+        require_index_url(model_url)
+        gps_lat, gps_lon, gps_accuracy_m = parse_gps_params(
+            raw_request_param(http_request, "gps_lat"),
+            raw_request_param(http_request, "gps_lon"),
+            raw_request_param(http_request, "gps_accuracy_m"),
+        )
 
-        if result is None:
-            result = "No matching waypoint found."
+        async def decode_query():
+            stream = QueryImageStream()
+            async for chunk in http_request.stream():
+                if not chunk:
+                    continue
+                # Anche senza Content-Length (chunked): stop appena oltre il limite
+                if stream.nbytes + len(chunk) > INFERENCE_MAX_IMAGE_BYTES:
+                    raise image_too_large()
+                stream.feed(chunk)
+
+            if stream.nbytes == 0:
+                raise CustomHTTPException(
+                    status_code=404,
+                    detail="Image not found",
+                    error_code=1004,
+                )
+            return await run_in_threadpool(stream.close)
 
-        return JSONResponse(
-            status_code=200,
-            content={
-                "model_url": model_url,
-                "report_url": f"/reports/{poi_name}",
-                "view_name": poi_name,
-                "poi_id": poi_id,
-                "message": result,
-            },
+        return await run_inference_request(
+            model_url, poi_name, poi_id, skip_geometry,
+            gps_lat, gps_lon, gps_accuracy_m, decode_query,
+            started_at, debug_timings=debug_timings,
         )
 
     except CustomHTTPException as e:
@@ -330,4 +859,4 @@ async def inference(http_request: FastAPIRequest):
             status_code=500,
             detail=str(e),
             error_code=1001,
-        )
\ No newline at end of file
+        )
@@ -0,0 +1,67 @@
+import time
+import threading
+from collections import deque
+
+
+def gps_cell(lat, lon, cell_deg):
+    """Cella GPS grossolana (indici interi di griglia); None senza GPS."""
+    if lat is None or lon is None or not cell_deg:
+        return None
+    return (int(lat // cell_deg), int(lon // cell_deg))
+
+
+class QueryResultCache:
+    """
+    Cache a breve TTL delle decisioni per frame ripetuti. Le voci sono
+    raggruppate per (versione dell'indice, cella GPS, opzioni) e dentro il
+    gruppo una query coincide con una precedente se gli hash percettivi
+    distano al massimo max_hamming bit.
+    """
+
+    def __init__(self, ttl_s, max_hamming=4, max_entries_per_group=64):
+        self.ttl_s = float(ttl_s)
+        self.max_hamming = int(max_hamming)
+        self.max_entries_per_group = int(max_entries_per_group)
+        self._groups = {}
+        self._lock = threading.Lock()
+        self._last_sweep = time.monotonic()
+        self.hits = 0
+        self.misses = 0
+
+    def _sweep(self, now):
+        for group in list(self._groups):
+            entries = self._groups[group]
+            while entries and entries[0][2] <= now:
+                entries.popleft()
+            if not entries:
+                del self._groups[group]
+        self._last_sweep = now
+
+    def get(self, group, phash):
+        """(True, risultato) per un frame quasi identico ancora valido, altrimenti (False, None)."""
+        now = time.monotonic()
+        with self._lock:
+            for cached_hash, result, expires_at in reversed(self._groups.get(group, ())):
+                if expires_at > now and bin(cached_hash ^ phash).count("1") <= self.max_hamming:
+                    self.hits += 1
+                    return True, result
+            self.misses += 1
+            return False, None
+
+    def put(self, group, phash, result):
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_sweep >= self.ttl_s:
+                self._sweep(now)
+            entries = self._groups.setdefault(group, deque(maxlen=self.max_entries_per_group))
+            entries.append((phash, result, now + self.ttl_s))
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": sum(len(entries) for entries in self._groups.values()),
+                "ttl_s": self.ttl_s,
+                "max_hamming": self.max_hamming,
+            }
@@ -0,0 +1,166 @@
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+class TourContextCache:
+    """
+    Cache LRU dei contesti dei tour, chiave index_url, con la versione
+    (ETag) dell'indice accanto al contesto. Limitata da un budget in byte
+    (size_fn stima i byte residenti di un contesto) e da un TTL di
+    inattivita': le voci non usate da idle_ttl_s secondi scadono.
+    Ogni voce ricorda quando la versione e' stata verificata sullo storage
+    (validated_at, time.monotonic) per la rivalidazione in background.
+    """
+
+    def __init__(self, max_bytes, size_fn, idle_ttl_s=None):
+        self.max_bytes = int(max_bytes)
+        self.idle_ttl_s = idle_ttl_s if idle_ttl_s and idle_ttl_s > 0 else None
+        self.size_fn = size_fn
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _drop(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= entry["nbytes"]
+        return entry
+
+    def _expire(self, now):
+        if self.idle_ttl_s is None:
+            return
+        # Ordine LRU: le voci scadute sono in testa
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if now - entry["last_access"] < self.idle_ttl_s:
+                break
+            self._drop(key)
+            self.expirations += 1
+
+    def get(self, key):
+        """Copia della voce di key (context, version, validated_at), altrimenti None."""
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            entry["last_access"] = now
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return dict(entry)
+
+    def peek(self, key):
+        """Come get, senza aggiornare LRU e contatori."""
+        with self._lock:
+            entry = self._entries.get(key)
+            return dict(entry) if entry is not None else None
+
+    def mark_validated(self, key, version):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry["version"] == version:
+                entry["validated_at"] = time.monotonic()
+
+    def mark_stale(self, key):
+        """Forza la rivalidazione di key alla prossima richiesta; False se assente."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False
+            entry["validated_at"] = float("-inf")
+            return True
+
+    def put(self, key, version, context):
+        """
+        Inserisce (o sostituisce) il contesto di key ed espelle i tour meno
+        usati finche' il totale rientra nel budget. La voce appena inserita
+        non viene mai espulsa, anche se da sola supera il budget.
+        """
+        nbytes = int(self.size_fn(context))
+        now = time.monotonic()
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = {
+                "version": version,
+                "context": context,
+                "nbytes": nbytes,
+                "last_access": now,
+                "validated_at": now,
+            }
+            self._bytes += nbytes
+            self._expire(now)
+
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                oldest = next(iter(self._entries))
+                self._drop(oldest)
+                self.evictions += 1
+                print(f"Evicted tour context {oldest} (cache {self._bytes} bytes)", flush=True)
+
+        return context
+
+    def clear(self):
+        with self._lock:
+            count = len(self._entries)
+            self._entries.clear()
+            self._bytes = 0
+        return count
+
+    def stats(self):
+        with self._lock:
+            self._expire(time.monotonic())
+            return {
+                "entries": len(self._entries),
+                "resident_bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "idle_ttl_s": self.idle_ttl_s,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "tours": {
+                    key: {"version": entry["version"], "bytes": entry["nbytes"]}
+                    for key, entry in self._entries.items()
+                },
+            }
+
+
+class SingleFlight:
+    """
+    Una sola esecuzione in corso per chiave: chi arriva mentre il caricamento
+    di una chiave e' gia' in corso attende lo stesso risultato (o la stessa
+    eccezione) invece di ripeterlo.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn):
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._calls[key] = future
+
+        if not leader:
+            return future.result()
+
+        try:
+            result = fn()
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
@@ -1,11 +1,13 @@
 #!/usr/bin/env python3
 import argparse
+import contextlib
 import csv
 import json
 import os
 import subprocess
 import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Optional
 
@@ -330,7 +332,7 @@ def cmd_pipeline(args):
 
     if args.query_dir:
         query_dir = Path(args.query_dir).resolve()
-        query_gps_map = load_query_gps_map(Path(args.query_gps).resolve() if args.query_gps else None)
+        query_gps_map = load_query_gps_map(Path(args.query_gps_json).resolve() if args.query_gps_json else None)
         images = collect_images(query_dir)
         if not images:
             eprint(f"[FAIL] Nessuna immagine trovata in {query_dir}")
@@ -425,7 +427,7 @@ def cmd_batch_eval(args):
     index_json = Path(args.index_json).resolve() if args.index_json else None
     tflite_model = Path(args.tflite_model).resolve() if args.tflite_model else None
     out_csv = Path(args.output_csv).resolve()
-    query_gps_map = load_query_gps_map(Path(args.query_gps).resolve() if args.query_gps else None)
+    query_gps_map = load_query_gps_map(Path(args.query_gps_json).resolve() if args.query_gps_json else None)
 
     rows = []
 
@@ -495,6 +497,548 @@ def cmd_batch_eval(args):
     print("  csv:", out_csv)
 
 
+def cmd_quant_recall(args):
+    """
+    Confronta il ranking con embedding float16 / int8 (scala per vettore)
+    con quello float32 su una cartella di query held-out (stessa
+    convenzione di batch-eval). Le query vengono embeddate una sola volta;
+    per ogni formato si ricostruisce solo la matrice degli embedding.
+    """
+    import numpy as np
+    infer = import_inference_script(args.ai_root)
+    from common.tour_index import BINARY_INDEX_EMBEDDING_DTYPES, quantize_embeddings
+
+    query_dir = Path(args.query_dir).resolve()
+    images = collect_images(query_dir)
+    if not images:
+        eprint(f"[FAIL] Nessuna immagine trovata in {query_dir}")
+        sys.exit(2)
+
+    with open(Path(args.index_json).resolve(), "r", encoding="utf-8") as f:
+        waypoint_index = json.load(f)
+
+    embedder = infer.TFLiteEmbedder(infer.load_tflite_interpreter(Path(args.tflite_model).resolve()))
+    queries = embed_query_images(infer, embedder, images, query_dir)
+
+    base_index = infer.build_embedding_index(waypoint_index)
+    view_weights = infer.get_query_view_weights()
+    top_k = args.top_k
+
+    rankings = {}
+    summary = {}
+    for dtype in BINARY_INDEX_EMBEDDING_DTYPES:
+        values, scales = quantize_embeddings(base_index["embeddings"], dtype)
+        embedding_index = dict(base_index, embeddings=values, embedding_scales=scales)
+        centroids = infer.compute_waypoint_centroids(embedding_index)
+
+        rankings[dtype] = [
+            infer.rank_waypoints_by_similarity(
+                query_embeddings,
+                embedding_index,
+                waypoint_index,
+                top_k_per_waypoint=infer.TOP_ITEMS_FOR_WAYPOINT_SCORE,
+                centroids=centroids,
+                view_weights=view_weights,
+            )
+            for _expected, query_embeddings in queries
+        ]
+
+        with_expected = [
+            (expected, [r["waypoint_name"] for r in ranked])
+            for (expected, _q), ranked in zip(queries, rankings[dtype])
+            if expected is not None
+        ]
+        reference = rankings["float32"]
+        agree = sum(
+            1 for ranked, ref in zip(rankings[dtype], reference)
+            if ranked and ref and ranked[0]["waypoint_name"] == ref[0]["waypoint_name"]
+        )
+        score_delta = [
+            abs(ranked[0]["final_score"] - ref[0]["final_score"])
+            for ranked, ref in zip(rankings[dtype], reference)
+            if ranked and ref
+        ]
+        embedding_bytes = values.nbytes + (scales.nbytes if scales is not None else 0)
+
+        summary[dtype] = {
+            "embedding_bytes": int(embedding_bytes),
+            "recall_at_1": (
+                round(sum(1 for e, names in with_expected if names[:1] == [e]) / len(with_expected), 4)
+                if with_expected else None
+            ),
+            f"recall_at_{top_k}": (
+                round(sum(1 for e, names in with_expected if e in names[:top_k]) / len(with_expected), 4)
+                if with_expected else None
+            ),
+            "top1_agreement_vs_float32": round(agree / len(queries), 4),
+            "mean_abs_top1_score_delta": round(float(np.mean(score_delta)), 6) if score_delta else 0.0,
+        }
+
+    print("\n[QUANTIZATION RECALL]")
+    print("  queries:", len(queries))
+    for dtype, stats in summary.items():
+        print(f"  {dtype}:")
+        for key, value in stats.items():
+            print(f"    {key}: {value}")
+
+    if args.output_json:
+        out_json = Path(args.output_json).resolve()
+        out_json.parent.mkdir(parents=True, exist_ok=True)
+        with open(out_json, "w", encoding="utf-8") as f:
+            json.dump({"queries": len(queries), "results": summary}, f, indent=2)
+        print("  json:", out_json)
+
+
+def embed_query_images(infer, embedder, images, query_dir):
+    """(waypoint atteso, embedding per vista) di ogni query, come in run_inference."""
+    queries = []
+    for img_path in images:
+        query_image = infer.QueryImage.from_path(img_path)
+        if infer.MULTI_VIEW_ENABLED:
+            query_embeddings = infer.extract_query_embeddings_multi_view_tflite(query_image.embedding_pil, embedder)
+        else:
+            processed = infer.preprocess_image_dart_compatible(query_image.embedding_pil)
+            query_embeddings = {"center": embedder.embed(processed)}
+        queries.append((expected_from_parent(img_path, query_dir), query_embeddings))
+    return queries
+
+
+def cmd_hierarchical_recall(args):
+    """
+    Confronta il ranking gerarchico (centroidi, poi item dei soli waypoint
+    selezionati) con quello esaustivo sulle stesse query, per ogni coppia
+    (top waypoint, margine): accordo sul top1, recall dei primi K waypoint
+    esaustivi, frazione dell'indice valutata e tempo medio di ranking.
+    """
+    import numpy as np
+    infer = import_inference_script(args.ai_root)
+
+    query_dir = Path(args.query_dir).resolve()
+    images = collect_images(query_dir)
+    if not images:
+        eprint(f"[FAIL] Nessuna immagine trovata in {query_dir}")
+        sys.exit(2)
+
+    embedder = infer.TFLiteEmbedder(infer.load_tflite_interpreter(Path(args.tflite_model).resolve()))
+    queries = embed_query_images(infer, embedder, images, query_dir)
+
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        context = infer.load_index_content(
+            str(Path(args.index_json).resolve()),
+            ann_min_items=None,
+            hierarchical_min_waypoints=None,
+        )
+    embedding_index = context["embedding_index"]
+    waypoint_index = context["waypoint_index"]
+    centroids = context["centroids"]
+    view_weights = context["view_weights"]
+    n_columns = len(embedding_index["embeddings"])
+    top_k = args.top_k
+
+    def rank(query_embeddings, columns=None):
+        return infer.rank_waypoints_by_similarity(
+            query_embeddings,
+            embedding_index,
+            waypoint_index,
+            top_k_per_waypoint=infer.TOP_ITEMS_FOR_WAYPOINT_SCORE,
+            centroids=centroids,
+            view_weights=view_weights,
+            columns=columns,
+        )
+
+    started = time.perf_counter()
+    exhaustive = [rank(query_embeddings) for _expected, query_embeddings in queries]
+    exhaustive_ms = (time.perf_counter() - started) * 1000.0 / len(queries)
+
+    results = []
+    for top_waypoints in args.top_waypoints:
+        for margin in args.margins:
+            agree = 0
+            recall_at_k = []
+            scored_fraction = []
+            correct = 0
+            elapsed_s = 0.0
+            for (expected, query_embeddings), reference in zip(queries, exhaustive):
+                started = time.perf_counter()
+                query_matrix = np.stack([infer.l2_normalize_np(q) for q in query_embeddings.values()])
+                view_weight_array = np.asarray(
+                    [float(view_weights.get(v, 1.0)) for v in query_embeddings], dtype=np.float32
+                )
+                columns = infer.columns_of_waypoints(
+                    embedding_index,
+                    infer.centroid_shortlist(
+                        query_matrix, view_weight_array, centroids,
+                        top_waypoints=top_waypoints, margin=margin,
+                    ),
+                )
+                ranked = rank(query_embeddings, columns=columns)
+                elapsed_s += time.perf_counter() - started
+
+                names = [r["waypoint_name"] for r in ranked[:top_k]]
+                reference_names = [r["waypoint_name"] for r in reference[:top_k]]
+                agree += bool(ranked and reference and names[0] == reference_names[0])
+                if reference_names:
+                    recall_at_k.append(len(set(names) & set(reference_names)) / len(reference_names))
+                scored_fraction.append(len(columns) / n_columns if n_columns else 0.0)
+                correct += expected is not None and names[:1] == [expected]
+
+            with_expected = sum(1 for expected, _q in queries if expected is not None)
+            results.append({
+                "top_waypoints": top_waypoints,
+                "margin": margin,
+                "top1_agreement_vs_exhaustive": round(agree / len(queries), 4),
+                f"recall_at_{top_k}_vs_exhaustive": round(float(np.mean(recall_at_k)), 4) if recall_at_k else None,
+                "accuracy": round(correct / with_expected, 4) if with_expected else None,
+                "mean_scored_fraction": round(float(np.mean(scored_fraction)), 4),
+                "mean_rank_ms": round(elapsed_s * 1000.0 / len(queries), 3),
+            })
+
+    exhaustive_correct = sum(
+        1 for (expected, _q), ranked in zip(queries, exhaustive)
+        if expected is not None and ranked and ranked[0]["waypoint_name"] == expected
+    )
+    with_expected = sum(1 for expected, _q in queries if expected is not None)
+
+    print("\n[HIERARCHICAL RECALL]")
+    print("  queries:", len(queries))
+    print("  waypoints:", len(centroids))
+    print("  embeddings:", n_columns)
+    print("  exhaustive_rank_ms:", round(exhaustive_ms, 3))
+    if with_expected:
+        print("  exhaustive_accuracy:", round(exhaustive_correct / with_expected, 4))
+    for result in results:
+        print(f"  top_waypoints={result['top_waypoints']} margin={result['margin']}:")
+        for key, value in result.items():
+            if key not in ("top_waypoints", "margin"):
+                print(f"    {key}: {value}")
+
+    if args.output_json:
+        out_json = Path(args.output_json).resolve()
+        out_json.parent.mkdir(parents=True, exist_ok=True)
+        with open(out_json, "w", encoding="utf-8") as f:
+            json.dump({
+                "queries": len(queries),
+                "waypoints": len(centroids),
+                "embeddings": n_columns,
+                "exhaustive_rank_ms": round(exhaustive_ms, 3),
+                "results": results,
+            }, f, indent=2)
+        print("  json:", out_json)
+
+
+def cmd_quality_check(args):
+    """
+    Verifica che il blur sia misurato come sulle foto dell'app: ogni query
+    viene portata a lato corto --upload-short-side (come camera_screen.dart)
+    e sfocata con --blur-sigma. La varianza del Laplaciano di QueryImage
+    (decodifica ridotta) deve coincidere con quella sull'upload a piena
+    risoluzione e la versione sfocata deve risultare blurry.
+    """
+    import cv2
+    import numpy as np
+    infer = import_inference_script(args.ai_root)
+
+    query_dir = Path(args.query_dir).resolve()
+    images = collect_images(query_dir)
+    if not images:
+        eprint(f"[FAIL] Nessuna immagine trovata in {query_dir}")
+        sys.exit(2)
+
+    def upload_bytes(bgr):
+        ok, encoded = cv2.imencode(".jpg", bgr, [cv2.IMWRITE_JPEG_QUALITY, 85])
+        if not ok:
+            raise ValueError("Encoding JPEG fallito")
+        return encoded.tobytes()
+
+    failures = []
+    print("\n[QUALITY CHECK]")
+    for img_path in images:
+        bgr = cv2.imread(str(img_path), cv2.IMREAD_COLOR)
+        if bgr is None:
+            continue
+        h, w = bgr.shape[:2]
+        scale = args.upload_short_side / min(h, w)
+        upload = cv2.resize(bgr, (round(w * scale), round(h * scale)), interpolation=cv2.INTER_AREA if scale < 1 else cv2.INTER_CUBIC)
+
+        for sigma in (0.0, args.blur_sigma):
+            data = upload_bytes(cv2.GaussianBlur(upload, (0, 0), sigma) if sigma > 0 else upload)
+            full_res = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+            full_res_var = float(cv2.Laplacian(full_res, cv2.CV_64F).var())
+
+            quality = infer.assess_image_quality(infer.QueryImage.from_bytes(data))
+            blurry = any(flag in quality["flags"] for flag in ("very_blurry", "slightly_blurry"))
+            deviation = abs(quality["blur_var"] - full_res_var) / max(full_res_var, 1e-6)
+
+            print(
+                f"  {img_path.name} sigma={sigma:.1f} | full_res={full_res_var:.1f} | "
+                f"query={quality['blur_var']:.1f} | flags={quality['flags']}"
+            )
+            if deviation > args.max_deviation:
+                failures.append(f"{img_path.name} sigma={sigma}: blur_var devia del {deviation:.1%}")
+            if sigma > 0 and not blurry:
+                failures.append(f"{img_path.name} sigma={sigma}: query sfocata non segnalata")
+
+    if failures:
+        for failure in failures:
+            eprint("[FAIL]", failure)
+        sys.exit(1)
+    print("  [OK]")
+
+
+def import_inference_script(ai_root):
+    """Importa inference/inference_script.py nel processo corrente."""
+    ai_root = Path(ai_root).resolve()
+    for path in (ai_root, ai_root / "inference"):
+        if str(path) not in sys.path:
+            sys.path.insert(0, str(path))
+
+    import inference_script
+    return inference_script
+
+
+def latency_summary(seconds):
+    """p50/p95/p99 e media in millisecondi di una lista di durate in secondi."""
+    import numpy as np
+
+    values = np.asarray(seconds, dtype=np.float64) * 1000.0
+    if values.size == 0:
+        return {"count": 0}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {
+        "count": int(values.size),
+        "p50": round(float(p50), 3),
+        "p95": round(float(p95), 3),
+        "p99": round(float(p99), 3),
+        "mean": round(float(values.mean()), 3),
+    }
+
+
+def run_benchmark_pass(infer, context, embedder, queries, workers, skip_geometry):
+    """
+    Esegue tutte le query con `workers` thread concorrenti sullo stesso
+    contesto e sullo stesso embedder. Restituisce (righe per query, secondi).
+    """
+    def run_one(query):
+        timings = {}
+        report = {}
+        started = time.perf_counter()
+        query_image = infer.QueryImage.from_bytes(query["image_bytes"])
+        timings["decode"] = time.perf_counter() - started
+        pred = infer.run_inference(
+            query_image=query_image,
+            context=context,
+            embedder=embedder,
+            skip_geometry=skip_geometry,
+            gps_lat=query["gps_lat"],
+            gps_lon=query["gps_lon"],
+            gps_accuracy_m=query["gps_accuracy_m"],
+            timings=timings,
+            report=report,
+        )
+        timings["total"] = time.perf_counter() - started
+        return pred, timings, report
+
+    started = time.perf_counter()
+    # Il logging della pipeline non deve finire nelle misure
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            outcomes = list(executor.map(run_one, queries))
+    wall_s = time.perf_counter() - started
+
+    rows = []
+    for query, (pred, timings, report) in zip(queries, outcomes):
+        expected = query["expected"]
+        rows.append({
+            "image_path": query["image_path"],
+            "expected_waypoint": expected,
+            "predicted_waypoint": pred,
+            "recognized": pred is not None,
+            "correct": pred == expected if expected is not None else "",
+            "decided_by": report.get("decided_by"),
+            "timings": timings,
+        })
+    return rows, wall_s
+
+
+def cmd_benchmark(args):
+    """
+    Valutazione e benchmark di latenza in-process: interprete TFLite e
+    contesto dell'indice (prepare_index_content) caricati una sola volta,
+    query eseguite nello stesso processo con N worker concorrenti. Per ogni
+    N riporta accuratezza, p50/p95/p99 per fase e throughput.
+    """
+    infer = import_inference_script(args.ai_root)
+
+    query_dir = Path(args.query_dir).resolve()
+    images = collect_images(query_dir)
+    if not images:
+        eprint(f"[FAIL] Nessuna immagine trovata in {query_dir}")
+        sys.exit(2)
+
+    query_gps_map = load_query_gps_map(Path(args.query_gps_json).resolve() if args.query_gps_json else None)
+    queries = []
+    for img_path in images:
+        gps_lat, gps_lon, gps_accuracy_m = get_query_gps_for_image(img_path, query_dir, query_gps_map)
+        queries.append({
+            "image_path": str(img_path),
+            "expected": expected_from_parent(img_path, query_dir),
+            # Lette una volta: la lettura da disco resta fuori dalle misure
+            "image_bytes": img_path.read_bytes(),
+            "gps_lat": gps_lat,
+            "gps_lon": gps_lon,
+            "gps_accuracy_m": gps_accuracy_m if gps_accuracy_m is not None else infer.GPS_DEFAULT_ACCURACY_M,
+        })
+
+    pool_size = args.interpreter_pool_size or max(args.workers)
+    embedder = infer.TFLiteEmbedderPool(
+        Path(args.tflite_model).resolve(),
+        size=pool_size,
+        num_threads=args.interpreter_num_threads,
+    )
+    if args.embed_batch_max > 1:
+        embedder = infer.MicroBatchingEmbedder(
+            embedder,
+            max_batch=args.embed_batch_max,
+            max_wait_ms=args.embed_batch_wait_ms,
+        )
+
+    started = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        context = infer.load_index_content(
+            str(Path(args.index_json).resolve()),
+            matcher_backend=args.matcher_backend,
+            ann_min_items=args.ann_min_items,
+        )
+    index_load_s = time.perf_counter() - started
+
+    if args.warmup > 0:
+        run_benchmark_pass(infer, context, embedder, queries[:args.warmup], 1, args.skip_geometry)
+
+    results = []
+    csv_rows = []
+    for workers in args.workers:
+        rows = []
+        wall_s = 0.0
+        for _ in range(args.repeat):
+            pass_rows, pass_wall_s = run_benchmark_pass(
+                infer, context, embedder, queries, workers, args.skip_geometry
+            )
+            rows.extend(pass_rows)
+            wall_s += pass_wall_s
+
+        stage_seconds = {}
+        for row in rows:
+            for stage, value in row["timings"].items():
+                stage_seconds.setdefault(stage, []).extend(value if isinstance(value, list) else [value])
+
+        # Per stadio della cascata: quante decisioni e con che accuratezza
+        decided_by = {}
+        for row in rows:
+            stats = decided_by.setdefault(row["decided_by"], {"count": 0, "with_expected": 0, "correct": 0})
+            stats["count"] += 1
+            if row["expected_waypoint"]:
+                stats["with_expected"] += 1
+                stats["correct"] += bool(row["correct"])
+        decided_by = {
+            stage: {
+                "count": stats["count"],
+                "accuracy": (
+                    round(stats["correct"] / stats["with_expected"], 4)
+                    if stats["with_expected"] else None
+                ),
+            }
+            for stage, stats in sorted(decided_by.items(), key=lambda kv: str(kv[0]))
+        }
+
+        with_expected = [r for r in rows if r["expected_waypoint"]]
+        results.append({
+            "workers": workers,
+            "queries": len(rows),
+            "wall_sec": round(wall_s, 4),
+            "throughput_qps": round(len(rows) / wall_s, 3) if wall_s > 0 else None,
+            "recognition_rate": round(sum(1 for r in rows if r["recognized"]) / len(rows), 4),
+            "accuracy": (
+                round(sum(1 for r in with_expected if r["correct"]) / len(with_expected), 4)
+                if with_expected else None
+            ),
+            "decided_by": decided_by,
+            "stages_ms": {stage: latency_summary(values) for stage, values in sorted(stage_seconds.items())},
+        })
+
+        for row in rows:
+            csv_rows.append({
+                "workers": workers,
+                "image_path": row["image_path"],
+                "expected_waypoint": row["expected_waypoint"],
+                "predicted_waypoint": row["predicted_waypoint"],
+                "recognized": row["recognized"],
+                "correct": row["correct"],
+                "decided_by": row["decided_by"],
+                "total_ms": round(row["timings"]["total"] * 1000.0, 3),
+            })
+
+    print("\n[BENCHMARK]")
+    print("  images:", len(queries))
+    print("  repeat:", args.repeat)
+    print("  index_load_sec:", round(index_load_s, 3))
+    for result in results:
+        print(f"  workers={result['workers']}:")
+        print("    throughput_qps:", result["throughput_qps"])
+        print("    recognition_rate:", result["recognition_rate"])
+        if result["accuracy"] is not None:
+            print("    accuracy:", result["accuracy"])
+        for stage, stats in result["decided_by"].items():
+            print(f"    decided_by={stage}: count={stats['count']} | accuracy={stats['accuracy']}")
+        for stage, stats in result["stages_ms"].items():
+            print(
+                f"    {stage}: p50={stats['p50']:.2f}ms | "
+                f"p95={stats['p95']:.2f}ms | p99={stats['p99']:.2f}ms | n={stats['count']}"
+            )
+
+    if args.output_json:
+        out_json = Path(args.output_json).resolve()
+        out_json.parent.mkdir(parents=True, exist_ok=True)
+        with open(out_json, "w", encoding="utf-8") as f:
+            json.dump({
+                "config": {
+                    "query_dir": str(query_dir),
+                    "index_json": str(Path(args.index_json).resolve()),
+                    "images": len(queries),
+                    "repeat": args.repeat,
+                    "warmup": args.warmup,
+                    "skip_geometry": args.skip_geometry,
+                    "matcher_backend": args.matcher_backend,
+                    "interpreter_pool_size": pool_size,
+                    "interpreter_num_threads": args.interpreter_num_threads,
+                    "embed_batch_max": args.embed_batch_max,
+                },
+                "index_load_sec": round(index_load_s, 4),
+                "results": results,
+            }, f, indent=2)
+        print("  json:", out_json)
+
+    if args.output_csv:
+        out_csv = Path(args.output_csv).resolve()
+        out_csv.parent.mkdir(parents=True, exist_ok=True)
+        with open(out_csv, "w", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(
+                f,
+                fieldnames=[
+                    "workers",
+                    "image_path",
+                    "expected_waypoint",
+                    "predicted_waypoint",
+                    "recognized",
+                    "correct",
+                    "decided_by",
+                    "total_ms",
+                ],
+            )
+            writer.writeheader()
+            writer.writerows(csv_rows)
+        print("  csv:", out_csv)
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Local tester for AI_classification/new training and inference."
@@ -572,6 +1116,66 @@ def main():
     p_eval.add_argument("--query-gps-json", help="JSON path relativo query image -> GPS per batch eval")
     p_eval.set_defaults(func=cmd_batch_eval)
 
+    # quant-recall
+    p_quant = subparsers.add_parser(
+        "quant-recall",
+        help="Confronta il ranking con embedding float16/int8 rispetto a float32",
+    )
+    p_quant.add_argument("--query-dir", required=True, help="Cartella query held-out, sottocartelle = waypoint atteso")
+    p_quant.add_argument("--index-json", required=True, help="Path training_data.json con embedding float32")
+    p_quant.add_argument("--tflite-model", required=True, help="Path .tflite")
+    p_quant.add_argument("--top-k", type=int, default=5, help="K per la recall@K")
+    p_quant.add_argument("--output-json", help="JSON di output con le metriche per formato")
+    p_quant.set_defaults(func=cmd_quant_recall)
+
+    # hierarchical-recall
+    p_hier = subparsers.add_parser(
+        "hierarchical-recall",
+        help="Confronta il ranking gerarchico centroidi -> item con quello esaustivo",
+    )
+    p_hier.add_argument("--query-dir", required=True, help="Cartella query held-out, sottocartelle = waypoint atteso")
+    p_hier.add_argument("--index-json", required=True, help="Path training_data.json o training_data.bin")
+    p_hier.add_argument("--tflite-model", required=True, help="Path .tflite")
+    p_hier.add_argument("--top-waypoints", type=int, nargs="+", default=[5, 10, 20], help="Waypoint tenuti dai centroidi (M)")
+    p_hier.add_argument("--margins", type=float, nargs="+", default=[0.0, 0.05, 0.10], help="Margine sotto l'M-esimo centroide")
+    p_hier.add_argument("--top-k", type=int, default=5, help="K per la recall@K rispetto all'esaustivo")
+    p_hier.add_argument("--output-json", help="JSON di output con le metriche per configurazione")
+    p_hier.set_defaults(func=cmd_hierarchical_recall)
+
+    # quality-check
+    p_quality = subparsers.add_parser(
+        "quality-check",
+        help="Verifica la misura del blur sulle query ridotte rispetto all'upload a piena risoluzione",
+    )
+    p_quality.add_argument("--query-dir", required=True, help="Cartella di immagini nitide")
+    p_quality.add_argument("--blur-sigma", type=float, default=3.0, help="Sigma del blur gaussiano applicato all'upload")
+    p_quality.add_argument("--upload-short-side", type=int, default=1024, help="Lato corto delle foto inviate dall'app")
+    p_quality.add_argument("--max-deviation", type=float, default=0.05, help="Scarto relativo massimo della varianza")
+    p_quality.set_defaults(func=cmd_quality_check)
+
+    # benchmark in-process
+    p_bench = subparsers.add_parser(
+        "benchmark",
+        help="Accuratezza e latenza per fase in-process (modello e indice caricati una volta)",
+    )
+    p_bench.add_argument("--query-dir", required=True, help="Cartella query, sottocartelle = waypoint atteso")
+    p_bench.add_argument("--index-json", required=True, help="Path training_data.json o training_data.bin")
+    p_bench.add_argument("--tflite-model", required=True, help="Path .tflite")
+    p_bench.add_argument("--workers", type=int, nargs="+", default=[1], help="Worker concorrenti da misurare (es. 1 2 4)")
+    p_bench.add_argument("--repeat", type=int, default=1, help="Passate sulla cartella per ogni numero di worker")
+    p_bench.add_argument("--warmup", type=int, default=2, help="Query eseguite prima delle misure e scartate")
+    p_bench.add_argument("--skip-geometry", action="store_true", help="Salta fase di verifica geometrica")
+    p_bench.add_argument("--query-gps-json", help="JSON path relativo query image -> GPS")
+    p_bench.add_argument("--matcher-backend", choices=["bf", "flann_lsh", "bf_waypoint"], default="bf", help="Matcher ORB per la verifica geometrica")
+    p_bench.add_argument("--ann-min-items", type=int, default=20000, help="Soglia di embedding per l'indice IVF")
+    p_bench.add_argument("--interpreter-pool-size", type=int, default=None, help="Interpreti TFLite (default: max worker)")
+    p_bench.add_argument("--interpreter-num-threads", type=int, default=None, help="Thread per interprete TFLite")
+    p_bench.add_argument("--embed-batch-max", type=int, default=1, help="Micro-batching degli embedding (1 = disattivato)")
+    p_bench.add_argument("--embed-batch-wait-ms", type=float, default=5.0, help="Attesa massima del micro-batcher")
+    p_bench.add_argument("--output-json", help="JSON di output con configurazione e metriche per numero di worker")
+    p_bench.add_argument("--output-csv", help="CSV di output con le predizioni per query")
+    p_bench.set_defaults(func=cmd_benchmark)
+
     args = parser.parse_args()
     args.func(args)
 
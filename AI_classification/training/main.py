@@ -21,12 +21,21 @@ import subprocess
 import base64
 import dotenv
 import json
+from common.tour_index import (
+    INDEX_BUILD_ID_METADATA_KEY,
+    binary_index_path,
+    index_build_id,
+)
 
 dotenv.load_dotenv()
 
 MINIO_ENDPOINT = os.getenv("AWS_S3_ENDPOINT_URL")
 CALLBACK_ENDPOINT = os.getenv("CALLBACK_ENDPOINT")
 
+# float32 | float16 | int8: formato degli embedding in training_data.bin / .json
+INDEX_BINARY_EMBEDDING_DTYPE = os.getenv("INDEX_BINARY_EMBEDDING_DTYPE", "float32")
+INDEX_JSON_EMBEDDING_DTYPE = os.getenv("INDEX_JSON_EMBEDDING_DTYPE", "float32")
+
 
 class CustomHTTPException(HTTPException):
     def __init__(self, status_code: int, detail: str, error_code: int):
@@ -120,17 +129,31 @@ def read_s3_file(file_name):
         return None
 
 
-def write_s3_file(file_path, remote_path):
+def write_s3_file(file_path, remote_path, metadata=None):
+    """Carica file_path su S3; restituisce False se l'upload fallisce."""
     print(f"Writing file {file_path} to S3 at {remote_path}", flush=True)
     try:
         s3.upload_file(
             file_path,
             os.getenv("AWS_STORAGE_BUCKET_NAME"),
             remote_path,
+            ExtraArgs={"Metadata": metadata} if metadata else None,
         )
         print(f"File {remote_path} written to S3", flush=True)
+        return True
     except Exception as e:
         print(f"Error writing file {file_path} to S3: {e}", flush=True)
+        return False
+
+def delete_s3_file(remote_path):
+    print(f"Deleting {remote_path} from S3", flush=True)
+    try:
+        s3.delete_object(
+            Bucket=os.getenv("AWS_STORAGE_BUCKET_NAME"),
+            Key=remote_path,
+        )
+    except Exception as e:
+        print(f"Error deleting {remote_path} from S3: {e}", flush=True)
 
 def _stream_output(stream, prefix=""):
     for line in iter(stream.readline, ""):
@@ -161,6 +184,10 @@ def run_training_subproc(
             tflite_model,
             "--tour-id",
             str(tour_id),
+            "--binary-embedding-dtype",
+            INDEX_BINARY_EMBEDDING_DTYPE,
+            "--json-embedding-dtype",
+            INDEX_JSON_EMBEDDING_DTYPE,
         ]
         
         if waypoint_gps_json:
@@ -247,9 +274,22 @@ def run_train(request: Request, view_dir: str, data_path: str):
         #     model_path, f"{request.poi_id}/model.pt"
         # )
         
-        write_s3_file(
-            offline_model_path, f"{request.poi_id}/training_data.json"
+        # Stesso build_id nei metadati di JSON e .bin: l'inferenza usa il
+        # .bin solo se corrisponde al JSON pubblicato
+        upload_metadata = {INDEX_BUILD_ID_METADATA_KEY: index_build_id(offline_model_path)}
+        offline_binary_path = binary_index_path(offline_model_path)
+        binary_key = f"{request.poi_id}/training_data.bin"
+        binary_uploaded = offline_binary_path.exists() and write_s3_file(
+            str(offline_binary_path), binary_key, metadata=upload_metadata
         )
+        if not binary_uploaded:
+            # Non lasciare accanto al nuovo JSON il .bin del build precedente
+            delete_s3_file(binary_key)
+
+        if not write_s3_file(
+            offline_model_path, f"{request.poi_id}/training_data.json", metadata=upload_metadata
+        ):
+            raise Exception("Upload of training_data.json failed")
 
         callback_payload = {
             "poi_id": int(request.poi_id),
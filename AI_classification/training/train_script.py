@@ -28,6 +28,15 @@ from common.preprocessing import (
     generate_reference_variants,
     get_reference_variant_weights,
 )
+from common.tour_index import (
+    BINARY_INDEX_EMBEDDING_DTYPES,
+    JSON_INDEX_EMBEDDING_DTYPES,
+    binary_index_path,
+    index_build_id,
+    index_calibration_stats,
+    json_index_entries,
+    write_binary_index,
+)
 
 
 INPUT_SIZE = 224
@@ -139,6 +148,8 @@ def create_training_index_with_tflite(
     tour_id: int,
     waypoint_gps_json: Path | None = None,
     default_gps_radius_m: float = 75.0,
+    binary_embedding_dtype: str = "float32",
+    json_embedding_dtype: str = "float32",
 ):
     print(f"\n🚀 Generating TFLite-based index for tour {tour_id}")
     interpreter = load_tflite_interpreter(tflite_model_path)
@@ -230,9 +241,22 @@ def create_training_index_with_tflite(
 
     output_json.parent.mkdir(parents=True, exist_ok=True)
     with open(output_json, "w", encoding="utf-8") as f:
-        json.dump(index, f, ensure_ascii=False, indent=2)
+        json.dump(json_index_entries(index, json_embedding_dtype), f, ensure_ascii=False, indent=2)
+
+    print(
+        f"\n✅ TFLite index saved to {output_json} "
+        f"({processed} images/variants, embeddings {json_embedding_dtype})"
+    )
 
-    print(f"\n✅ TFLite index saved to {output_json} ({processed} images/variants)")
+    calibration = index_calibration_stats(index)
+    output_binary = write_binary_index(
+        index,
+        binary_index_path(output_json),
+        embedding_dtype=binary_embedding_dtype,
+        calibration=calibration,
+        build_id=index_build_id(output_json),
+    )
+    print(f"✅ Binary index saved to {output_binary} (embeddings {binary_embedding_dtype})")
 
 def main():
     parser = argparse.ArgumentParser(
@@ -271,6 +295,18 @@ def main():
         default=75.0,
         help="Raggio in metri da usare se i dati GPS specifici del waypoint non sono disponibili (default: 75m).",
     )
+    parser.add_argument(
+        "--binary-embedding-dtype",
+        choices=BINARY_INDEX_EMBEDDING_DTYPES,
+        default="float32",
+        help="Tipo degli embedding nell'indice binario training_data.bin (default: float32).",
+    )
+    parser.add_argument(
+        "--json-embedding-dtype",
+        choices=JSON_INDEX_EMBEDDING_DTYPES,
+        default="float32",
+        help="Formato degli embedding in training_data.json, letto anche dall'app mobile (default: float32).",
+    )
 
     args = parser.parse_args()
 
@@ -300,6 +336,8 @@ def main():
             tour_id=args.tour_id,
             waypoint_gps_json=args.waypoint_gps_json,
             default_gps_radius_m=args.default_gps_radius_m,
+            binary_embedding_dtype=args.binary_embedding_dtype,
+            json_embedding_dtype=args.json_embedding_dtype,
         )
         
         print("\nDone.")
@@ -273,6 +273,23 @@ def clear_ai_inference_cache():
         print(f"Error clearing AI inference cache: {e}", flush=True)
         raise
     
+@shared_task
+def invalidate_ai_inference_cache(index_url):
+    url = os.getenv("INFERENCE_CACHE_INVALIDATE_ENDPOINT")
+
+    if not url:
+        print("INFERENCE_CACHE_INVALIDATE_ENDPOINT non è configurato.")
+        return "INFERENCE_CACHE_INVALIDATE_ENDPOINT non configurato"
+
+    try:
+        response = requests.post(url, json={"index_url": index_url}, timeout=30)
+        print(f"Cache invalidate response: {response.status_code} - {response.text}")
+        response.raise_for_status()
+        return response.json()
+    except Exception as e:
+        print(f"Error invalidating AI inference cache: {e}", flush=True)
+        raise
+
 @shared_task(queue='api_tasks')
 def generate_offline_bundle(tour_id):
     from xr_tour_guide_core.services.offline_bundle_service import OfflineBundleService
@@ -1,4 +1,6 @@
 import os
+import base64
+import binascii
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import IsAuthenticated
 from django.http import HttpResponse, JsonResponse, FileResponse
@@ -17,7 +19,7 @@ from django.conf import settings
 from ..authentication import JWTFastAPIAuthentication
 from drf_yasg.utils import swagger_auto_schema
 from drf_yasg import openapi
-from xr_tour_guide.tasks import generate_offline_bundle
+from xr_tour_guide.tasks import generate_offline_bundle, invalidate_ai_inference_cache
 
 
 redis_client = redis.StrictRedis.from_url(os.getenv("REDIS_URL", "redis://redis:6379"))
@@ -86,6 +88,7 @@ def complete_build(request):
             tour.status = "BUILT"
             tour.save()
             generate_offline_bundle.delay(tour.id)
+            invalidate_ai_inference_cache.delay(index_url)
         except Tour.DoesNotExist:
             return JsonResponse({"error": "POI not found"}, status=404)
         except Exception as e:
@@ -181,6 +184,14 @@ def load_model(request, tour_id):
         return JsonResponse({"error": "Model not found"}, status=404)
     return JsonResponse({"message": "Model loaded"}, status=200)
 
+def _decode_base64_image(data):
+    if data.startswith("data:"):
+        data = data.split(",")[1]
+    missing_padding = len(data) % 4
+    if missing_padding:
+        data += "=" * (4 - missing_padding)
+    return base64.b64decode(data)
+
 @swagger_auto_schema(
     method='post',
     operation_summary="Run inference on an image for a specific tour",
@@ -246,27 +257,37 @@ def inference(request):
     }
 
     url = os.getenv("INFERENCE_ENDPOINT")
+    # Endpoint a body binario: l'immagine viaggia come image/jpeg e i
+    # parametri in query string, senza base64 ne' multipart.
+    raw_url = os.getenv("INFERENCE_RAW_ENDPOINT") or f"{url.rstrip('/')}/raw"
+    params = {key: value for key, value in payload.items() if value not in (None, "")}
 
     uploaded_file = request.FILES.get("img") or request.FILES.get("image")
+    image_b64 = request.data.get("img")
 
     if uploaded_file is not None:
-        files = {
-            "image": (
-                uploaded_file.name or "query.jpg",
-                uploaded_file.read(),
-                uploaded_file.content_type or "image/jpeg",
-            )
-        }
+        # Il file viene letto a blocchi durante l'invio, non copiato in memoria
+        response = requests.post(
+            raw_url,
+            params=params,
+            data=uploaded_file,
+            headers={"Content-Type": uploaded_file.content_type or "image/jpeg"},
+            timeout=60,
+        )
+    elif image_b64:
+        try:
+            image_bytes = _decode_base64_image(image_b64)
+        except (binascii.Error, ValueError):
+            return JsonResponse({"error": "Invalid image"}, status=400)
 
         response = requests.post(
-            url,
-            data=payload,
-            files=files,
+            raw_url,
+            params=params,
+            data=image_bytes,
+            headers={"Content-Type": "application/octet-stream"},
             timeout=60,
         )
     else:
-        payload["inference_image"] = request.data.get("img")
-
         response = requests.post(
             url,
             headers={"Content-type": "application/json"},